@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Measure the cost of calling the hook chains of a handler with many mixins.
+
+:meth:`gaetk2.handlers.base.BasicHandler.dispatch` calls six hooks and
+:meth:`~gaetk2.handlers.base.BasicHandler.render` reduces `build_context`
+over all classes of the handler. This builds a handler with `--mixins`
+mixins each implementing all of them and measures one "request" worth of
+hook calls - with the cached hook chains and with the cache cleared
+before each request (which is what every request paid before the chains
+were cached). Needs `webapp2` and the App Engine SDK on the path.
+
+    python lib/appengine-toolkit2/bin/benchmark_dispatch.py --mixins 12
+
+Created by Maximillian Dornseif on 2019-03-14.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+import optparse
+import os
+import sys
+import time
+
+# so we can import gaetk2 when called as lib/appengine-toolkit2/bin/benchmark_dispatch.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import webapp2  # noqa: E402
+
+from gaetk2.handlers import base  # noqa: E402
+
+
+HOOKS = (
+    'pre_authentication_hook',
+    'authentication_preflight_hook',
+    'authentication_hook',
+    'authorisation_hook',
+    'method_preperation_hook',
+    'finished_hook',
+)
+
+
+def _hook(self, method_name, *args, **kwargs):
+    pass
+
+
+def _build_context(self, values):
+    values['depth'] = values.get('depth', 0) + 1
+    return values
+
+
+def build_handler_class(mixins):
+    """Return a handler class with `mixins` mixins implementing all hooks."""
+    namespace = dict((name, _hook) for name in HOOKS)
+    namespace['build_context'] = _build_context
+    bases = tuple(type(str('Mixin{}'.format(i)), (object,), dict(namespace)) for i in range(mixins))
+    return type(str('DeepHandler'), bases + (base.BasicHandler,), {})
+
+
+def time_requests(handler, iterations, cached):
+    """Return microseconds per request worth of hook calls."""
+    start = time.time()
+    for _ in range(iterations):
+        if not cached:
+            base._hook_chain_cache.clear()
+        for name in HOOKS:
+            handler._call_all_inherited(name, 'get')
+        handler._reduce_all_inherited('build_context', {})
+    return (time.time() - start) / iterations * 1000000
+
+
+def main():
+    """Main Entry Point."""
+    parser = optparse.OptionParser()
+    parser.add_option('-m', '--mixins', default=12, type='int', help=u'number of mixins')
+    parser.add_option('-n', '--iterations', default=20000, type='int', help=u'requests per measurement')
+    options, args = parser.parse_args()
+
+    handler_class = build_handler_class(options.mixins)
+    request = webapp2.Request.blank('/')
+    handler = handler_class(request, webapp2.Response())
+    print "{} mixins, {} classes in the MRO ({} iterations)".format(
+        options.mixins, len(handler_class.__mro__), options.iterations)
+    for label, cached in (('uncached', False), ('cached', True)):
+        print '  {:<9} {:>6.1f} us per request'.format(
+            label, time_requests(handler, options.iterations, cached))
+
+
+if __name__ == '__main__':
+    main()
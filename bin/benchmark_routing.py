@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compare route matching of `webapp2.Router` and `gaetk2.routing.IndexedRouter`.
+
+Builds an application with `--routes` routes like ``/app17/items/<item_id:\\d+>/``
+and measures how long matching the first, middle and last route and a
+path not matching at all takes. Needs `webapp2` and `webob` on the path,
+but not the App Engine SDK.
+
+    python lib/appengine-toolkit2/bin/benchmark_routing.py --routes 500
+
+Created by Maximillian Dornseif on 2019-03-25.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+import optparse
+import os
+import sys
+import time
+
+# so we can import gaetk2 when called as lib/appengine-toolkit2/bin/benchmark_routing.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import webapp2  # noqa: E402
+
+from gaetk2.routing import IndexedRouter  # noqa: E402
+
+
+class NullHandler(webapp2.RequestHandler):
+    def get(self, *args, **kwargs):
+        pass
+
+
+def build_routes(count):
+    """Return `count` routes with distinct prefixes."""
+    return [webapp2.Route('/app%d/items/<item_id:\\d+>/' % i, NullHandler) for i in range(count)]
+
+
+def time_match(router, path, iterations):
+    """Return microseconds per `router.match()` for `path`."""
+    request = webapp2.Request.blank(path)
+    start = time.time()
+    for _ in range(iterations):
+        try:
+            router.match(request)
+        except Exception:  # 404
+            pass
+    return (time.time() - start) / iterations * 1000000
+
+
+def check_semantics(routes, paths):
+    """Make sure both routers find the same route and arguments."""
+    plain, indexed = webapp2.Router(routes), IndexedRouter(routes)
+    for path in paths:
+        request = webapp2.Request.blank(path)
+        expected, got = plain.match(request), indexed.match(request)
+        assert expected[0] is got[0] and expected[1:] == got[1:], path
+
+
+def main():
+    """Main Entry Point."""
+    parser = optparse.OptionParser()
+    parser.add_option('-r', '--routes', default=500, type='int', help=u'number of routes')
+    parser.add_option('-n', '--iterations', default=2000, type='int', help=u'matches per measurement')
+    options, args = parser.parse_args()
+
+    routes = build_routes(options.routes)
+    last = options.routes - 1
+    paths = [
+        ('first', '/app0/items/123/'),
+        ('middle', '/app%d/items/123/' % (last // 2)),
+        ('last', '/app%d/items/123/' % last),
+        ('404', '/nothere/'),
+    ]
+    check_semantics(routes, [path for (_, path) in paths[:3]])
+    routers = [webapp2.Router(routes), IndexedRouter(routes)]
+    print "matching {} routes ({} iterations)".format(options.routes, options.iterations)
+    print '  {:<8} {:>12} {:>14}'.format('route', 'Router', 'IndexedRouter')
+    for label, path in paths:
+        timings = [time_match(router, path, options.iterations) for router in routers]
+        print '  {:<8} {:>9.0f} us {:>11.0f} us'.format(label, *timings)
+
+
+if __name__ == '__main__':
+    main()
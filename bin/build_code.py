@@ -7,11 +7,15 @@ Created by Maximillian Dornseif on 2018-01-11.
 Copyright (c) 2018 Cyberlogi. MIT licensed.
 """
 import collections
+import logging
 import optparse
 import os
 import subprocess
 import sys
 
+# so we can import gaetk2 when called as lib/appengine-toolkit2/bin/build_code.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 config = dict(
     GAE_VERSION='1.9.51'
 )
@@ -24,11 +28,43 @@ taskrunners = collections.OrderedDict([
 ])
 
 
+def get_template_config():
+    """Return `TEMPLATE_DIRS` and `TEMPLATE_COMPILED_DIR` as seen by the application.
+
+    Guessing would compile the wrong templates, so we refuse to continue
+    if the configuration can't be read.
+    """
+    try:
+        # needs the App Engine SDK to read `appengine_config.py`
+        sys.path.insert(0, os.getcwd())
+        from gaetk2.config import gaetkconfig
+    except ImportError as e:
+        sys.exit(
+            "-> can't read the template configuration ({}). "
+            'Put the App Engine SDK on PYTHONPATH to compile templates.'.format(e))
+    return gaetkconfig.TEMPLATE_DIRS, gaetkconfig.TEMPLATE_COMPILED_DIR
+
+
+def compile_templates(target=None):
+    """Compile Jinja2 templates to Python modules for faster cold starts."""
+    from gaetk2 import templating
+
+    template_dirs, compiled_dir = get_template_config()
+    target = target or compiled_dir
+    print "-> compiling templates from {} to {}".format(', '.join(template_dirs), target)
+    count = templating.compile_templates(template_dirs, target)
+    print "-> {} templates compiled".format(count)
+
+
 def main():
     """Main Entry Point."""
     parser = optparse.OptionParser()
     parser.add_option('-p', '--production', default=False, action='store_true', help=u'build production version')
+    parser.add_option('-t', '--templates', default=False, action='store_true',
+                      help=u'compile Jinja2 templates (always done for production)')
+    parser.add_option('--template-target', default=None, help=u'where to put compiled templates')
     options, args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
 
     if options.production:
         os.environ['NODE_ENV'] = 'production'
@@ -40,6 +76,9 @@ def main():
             cmd = command.format(**config)
             subprocess.check_call(cmd, shell=True)
 
+    if options.production or options.templates:
+        compile_templates(options.template_target)
+
 
 # # install required libraries
 # print '-> pip --quiet install -r requirements-dev.txt'
@@ -3,6 +3,7 @@
 # pylint: skip-file
 # flake8: noqa
 
+import collections
 import datetime
 import hashlib
 import hmac
@@ -12,6 +13,7 @@ import pickle
 import re
 import threading
 import time
+import zlib
 from base64 import b64decode, b64encode
 from Cookie import CookieError, SimpleCookie
 
@@ -24,6 +26,16 @@ COOKIE_NAME_PREFIX = "DgU"
 COOKIE_PATH = "/"
 DEFAULT_COOKIE_ONLY_THRESH = 10240  # 10KB: GAE only allows ~16000B in HTTP header - leave ~6KB for other info
 DEFAULT_LIFETIME = datetime.timedelta(days=7)
+# If set, sessions changing on every request are written to the datastore at
+# most once per this many seconds (per instance). Changes of COOKIE_HEADER_KEYS
+# are always written. Skipped writes are not repeated later: if memcache loses
+# the session, changes since the last datastore write are lost. So this is
+# off by default and only suitable for data which is safe to lose.
+DEFAULT_DATASTORE_WRITE_INTERVAL = 0
+# Values which are kept in cookies and memcache but never written to the
+# datastore, e.g. messages to be displayed on the next page. Changing them
+# alone does not cause a datastore write.
+VOLATILE_KEYS = ('_gaetk_messages',)
 
 # constants
 SID_LEN = 43  # timestamp (10 chars) + underscore + md5 (32 hex chars)
@@ -37,7 +49,34 @@ COOKIE_DATE_FMT = '%a, %d-%b-%Y %H:%M:%S GMT'
 COOKIE_OVERHEAD = len(COOKIE_FMT % (0, '', '')) + len('expires=Xxx, xx XXX XXXX XX:XX:XX GMT; ') + 150
 MAX_DATA_PER_COOKIE = MAX_COOKIE_LEN - COOKIE_OVERHEAD
 
+# Encoding of session data. The first byte tells the format:
+# ENCODING_ZLIB is followed by zlib compressed "pickled+" data, otherwise it is
+# plain "pickled+" data as written by older versions (starts with the pickle
+# protocol 2 marker '\x80'). Plain data is still written if compression doesn't help.
+ENCODING_ZLIB = '\x01'
+COMPRESS_LEVEL = 6
+# If the data is too big for the cookie, the cookie contains ENCODING_HEADER
+# followed by the values of COOKIE_HEADER_KEYS. Reading them needs no
+# loading of the session data. But a signed cookie stays valid after logout,
+# so terminating a session leaves REVOKED_PREFIX + sid in memcache and the
+# header is only trusted if that marker is missing (one small memcache get
+# per request). If memcache evicts the marker, a replayed old cookie is
+# accepted again until the data is needed or the session expires.
+ENCODING_HEADER = '\x02'
+COOKIE_HEADER_KEYS = ('uid', 'login_via', 'login_time')
+REVOKED_PREFIX = 'revoked:'
+
+# size distribution of encoded session data on this instance, see `get_size_stats()`
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384)
+_size_stats = dict(
+    saved=0, raw_bytes=0, encoded_bytes=0, cookie_only=0, backend=0,
+    backend_reads=0, backend_reads_avoided=0, header_revoked=0,
+    datastore_writes=0, datastore_writes_volatile_only=0, datastore_writes_ratelimited=0,
+    raw_sizes=[0] * (len(SIZE_BUCKETS) + 1), encoded_sizes=[0] * (len(SIZE_BUCKETS) + 1))
+
 _tls = threading.local()
+_last_datastore_write = collections.OrderedDict()  # sid -> timestamp, oldest first, see `Session.save()`
+_last_datastore_write_lock = threading.Lock()
 
 
 def get_current_session():
@@ -54,6 +93,28 @@ def is_gaesessions_key(k):
     return k.startswith(COOKIE_NAME_PREFIX)
 
 
+def _size_bucket(size):
+    for i, limit in enumerate(SIZE_BUCKETS):
+        if size <= limit:
+            return i
+    return len(SIZE_BUCKETS)
+
+
+def get_size_stats():
+    """Returns (approximate) statistics about the size of sessions saved on
+    this instance before (raw) and after compression (encoded) and about
+    memcache/datastore reads and writes.  `backend_reads_avoided` counts
+    requests for sessions stored in the backend which only needed
+    COOKIE_HEADER_KEYS, `header_revoked` cookie headers of terminated
+    sessions which were rejected.  `datastore_writes_volatile_only` and
+    `datastore_writes_ratelimited` count datastore writes which were skipped."""
+    labels = ['<=%d' % limit for limit in SIZE_BUCKETS] + ['>%d' % SIZE_BUCKETS[-1]]
+    ret = dict(_size_stats)
+    ret['raw_sizes'] = dict(zip(labels, _size_stats['raw_sizes']))
+    ret['encoded_sizes'] = dict(zip(labels, _size_stats['encoded_sizes']))
+    return ret
+
+
 class SessionModel(db.Model):
     """Contains session data.  key_name is the session ID and pdump contains a
     pickled dictionary which maps session variables to their values."""
@@ -69,18 +130,24 @@ class Session(object):
     DIRTY_BUT_DONT_PERSIST_TO_DB = 1
 
     def __init__(self, sid=None, lifetime=DEFAULT_LIFETIME, no_datastore=False,
-                 cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH, cookie_key=None):
+                 cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH, cookie_key=None,
+                 datastore_write_interval=DEFAULT_DATASTORE_WRITE_INTERVAL):
         self._accessed = False
         self.sid = None
         self.cookie_keys = []
         self.cookie_data = None
         self.data = {}
+        self.header = None  # COOKIE_HEADER_KEYS if the data is not in the cookie
+        self._header_checked = False  # checked `header` against REVOKED_PREFIX + sid?
         self.dirty = False  # has the session been changed?
+        self.dirty_keys = set()  # which keys have been changed? None means "all"
+        self._put_rpc = None  # pending datastore write
 
         self.lifetime = lifetime
         self.no_datastore = no_datastore
         self.cookie_only_thresh = cookie_only_threshold
         self.base_key = cookie_key
+        self.datastore_write_interval = datastore_write_interval
 
         if sid:
             self.__set_sid(sid, False)
@@ -114,7 +181,10 @@ class Session(object):
                 if self.get_expiration() != 0 and time.time() > self.get_expiration():
                     return self.terminate()
 
-                if pdump:
+                if pdump[:1] == ENCODING_HEADER:
+                    self.header = self.__decode_header(pdump)
+                    self.data = None  # data is in memcache/db: load it on-demand
+                elif pdump:
                     self.data = self.__decode_data(pdump)
                 else:
                     self.data = None  # data is in memcache/db: load it on-demand
@@ -198,9 +268,10 @@ class Session(object):
         return ('%010d' % expire_ts) + sep + hashlib.md5(os.urandom(16)).hexdigest()
 
     @staticmethod
-    def __encode_data(d):
+    def __encode_data(d, record_stats=True):
         """Returns a "pickled+" encoding of d.  d values of type db.Model are
-        protobuf encoded before pickling to minimize CPU usage & data size."""
+        protobuf encoded before pickling to minimize CPU usage & data size.
+        The result is zlib compressed if this makes it smaller."""
         # separate protobufs so we'll know how to decode (they are just strings)
         eP = {}  # for models encoded as protobufs
         eO = {}  # for everything else
@@ -209,12 +280,25 @@ class Session(object):
                 eP[k] = db.model_to_protobuf(v)
             else:
                 eO[k] = v
-        return pickle.dumps((eP, eO), 2)
+        pdump = pickle.dumps((eP, eO), 2)
+        compressed = ENCODING_ZLIB + zlib.compress(pdump, COMPRESS_LEVEL)
+        encoded = compressed if len(compressed) < len(pdump) else pdump
+        if not record_stats:
+            return encoded
+        _size_stats['saved'] += 1
+        _size_stats['raw_bytes'] += len(pdump)
+        _size_stats['encoded_bytes'] += len(encoded)
+        _size_stats['raw_sizes'][_size_bucket(len(pdump))] += 1
+        _size_stats['encoded_sizes'][_size_bucket(len(encoded))] += 1
+        return encoded
 
     @staticmethod
     def __decode_data(pdump):
-        """Returns a data dictionary after decoding it from "pickled+" form."""
+        """Returns a data dictionary after decoding it from "pickled+" form.
+        Compressed and uncompressed (old) data is accepted."""
         try:
+            if pdump[:1] == ENCODING_ZLIB:
+                pdump = zlib.decompress(pdump[1:])
             eP, eO = pickle.loads(pdump)
             for k, v in eP.iteritems():
                 eO[k] = db.model_from_protobuf(v)
@@ -223,6 +307,42 @@ class Session(object):
             eO = {}
         return eO
 
+    @staticmethod
+    def __encode_header(d):
+        """Returns the values of COOKIE_HEADER_KEYS from d for the cookie."""
+        header = dict((k, d[k]) for k in COOKIE_HEADER_KEYS if k in d)
+        return ENCODING_HEADER + pickle.dumps(header, 2)
+
+    @staticmethod
+    def __decode_header(pdump):
+        """Returns the header dictionary or None if it can't be decoded."""
+        try:
+            return pickle.loads(pdump[1:])
+        except Exception, e:
+            logging.warn("failed to decode session header: %s" % e)
+            return None
+
+    def __mark_dirty(self, key=None):
+        """Remembers that key (or - if None - the whole session) was changed."""
+        self.dirty = True
+        self.dirty_keys.add(key)
+
+    def __in_header(self, key):
+        """Returns True if key can be answered without loading the data.
+
+        The first time per request this checks that the session has not been
+        terminated (e.g. by a logout) - the cookie would still be valid."""
+        if self.data is not None or self.header is None or key not in COOKIE_HEADER_KEYS:
+            return False
+        if not self._header_checked:
+            self._header_checked = True
+            if memcache.get(REVOKED_PREFIX + self.sid, namespace='') is not None:
+                _size_stats['header_revoked'] += 1
+                logging.info("cookie header of terminated session received for sid=%s" % self.sid)
+                self.terminate(False)
+                return False
+        return True
+
     def regenerate_id(self, expiration_ts=None):
         """Assigns the session a new session ID (data carries over).  This
         should be called whenever a user authenticates to prevent session
@@ -236,7 +356,7 @@ class Session(object):
             if expiration_ts is None:
                 expiration_ts = self.get_expiration()
             self.__set_sid(self.__make_sid(expiration_ts, self.is_ssl_only()))
-            self.dirty = True  # ensure the data is written to the new session
+            self.__mark_dirty()  # ensure the data is written to the new session
 
     def start(self, expiration_ts=None, ssl_only=False):
         """Starts a new session.  expiration specifies when it will expire.  If
@@ -253,7 +373,7 @@ class Session(object):
         ``ssl_only`` - Whether to specify the "Secure" attribute on the cookie
         so that the client will ONLY transfer the cookie over a secure channel.
         """
-        self.dirty = True
+        self.__mark_dirty()
         self.data = {}
         self.__set_sid(self.__make_sid(expiration_ts, ssl_only), True)
 
@@ -263,6 +383,7 @@ class Session(object):
             self.__clear_data()
         self.sid = None
         self.data = {}
+        self.header = None
         self.dirty = False
         if self.cookie_keys:
             self.cookie_data = ''  # trigger the cookies to expire
@@ -285,6 +406,8 @@ class Session(object):
         """Deletes this session from memcache and the datastore."""
         if self.sid:
             memcache.delete(self.sid, namespace='')  # not really needed; it'll go away on its own
+            # cookies with only a header don't need the data, see `__in_header()`
+            memcache.set(REVOKED_PREFIX + self.sid, 1, namespace='', time=self.get_expiration())
             try:
                 db.delete(self.db_key)
             except:
@@ -294,6 +417,7 @@ class Session(object):
         """Sets the data associated with this session after retrieving it from
         memcache or the datastore.  Assumes self.sid is set.  Checks for session
         expiration after getting the data."""
+        _size_stats['backend_reads'] += 1
         pdump = memcache.get(self.sid, namespace='')
         if pdump is None:
             # memcache lost it, go to the datastore
@@ -325,30 +449,69 @@ class Session(object):
         """
         if not self.sid:
             return  # no session is active
+        if self.data is None and self.header is not None:
+            _size_stats['backend_reads_avoided'] += 1
         if not self.dirty:
             return  # nothing has changed
         dirty = self.dirty
+        dirty_keys = self.dirty_keys
         self.dirty = False  # saving, so it won't be dirty anymore
+        self.dirty_keys = set()
 
         # do the pickling ourselves b/c we need it for the datastore anyway
         pdump = self.__encode_data(self.data)
 
         # persist via cookies if it is reasonably small
         if len(pdump) * 4 / 3 <= self.cookie_only_thresh:  # 4/3 b/c base64 is ~33% bigger
+            _size_stats['cookie_only'] += 1
             self.cookie_data = pdump
             if not persist_even_if_using_cookie:
                 return
-        elif self.cookie_keys:
-            # latest data will only be in the backend, so expire data cookies we set
-            self.cookie_data = ''
+        else:
+            _size_stats['backend'] += 1
+            # latest data will only be in the backend, the cookie only gets the header
+            self.cookie_data = self.__encode_header(self.data)
+
+        # start the datastore write, so it runs in parallel to memcache.set()
+        if not (dirty is Session.DIRTY_BUT_DONT_PERSIST_TO_DB or self.no_datastore):
+            self.__persist_async(pdump, dirty_keys)
 
         memcache.set(self.sid, pdump, namespace='', time=self.get_expiration())  # may fail if memcache is down
 
-        # persist the session to the datastore
-        if dirty is Session.DIRTY_BUT_DONT_PERSIST_TO_DB or self.no_datastore:
+    def __persist_async(self, pdump, dirty_keys):
+        """Starts writing the session to the datastore if needed.  See `wait()`."""
+        if not [k for k in dirty_keys if k not in VOLATILE_KEYS]:
+            _size_stats['datastore_writes_volatile_only'] += 1
+            return
+        now = time.time()
+        if (self.datastore_write_interval
+                and not [k for k in dirty_keys if k is None or k in COOKIE_HEADER_KEYS]
+                and now - _last_datastore_write.get(self.sid, 0) < self.datastore_write_interval):
+            _size_stats['datastore_writes_ratelimited'] += 1
+            return
+        if self.datastore_write_interval:
+            with _last_datastore_write_lock:
+                _last_datastore_write.pop(self.sid, None)
+                _last_datastore_write[self.sid] = now
+                # forget sessions which are not rate limited any more
+                while now - next(_last_datastore_write.itervalues()) >= self.datastore_write_interval:
+                    _last_datastore_write.popitem(last=False)
+        if [k for k in VOLATILE_KEYS if k in self.data]:
+            pdump = self.__encode_data(
+                dict((k, v) for k, v in self.data.iteritems() if k not in VOLATILE_KEYS), False)
+        _size_stats['datastore_writes'] += 1
+        try:
+            self._put_rpc = db.put_async(SessionModel(key_name=self.sid, pdump=pdump))
+        except Exception, e:
+            logging.warning("unable to persist session to datastore for sid=%s (%s)" % (self.sid, e))
+
+    def wait(self):
+        """Waits for the datastore write started by `save()` (if any)."""
+        rpc, self._put_rpc = self._put_rpc, None
+        if rpc is None:
             return
         try:
-            SessionModel(key_name=self.sid, pdump=pdump).put()
+            rpc.get_result()
         except Exception, e:
             logging.warning("unable to persist session to datastore for sid=%s (%s)" % (self.sid, e))
 
@@ -357,22 +520,24 @@ class Session(object):
         """Removes all data from the session (but does not terminate it)."""
         if self.sid:
             self.data = {}
-            self.dirty = True
+            self.__mark_dirty()
 
     def get(self, key, default=None):
         """Retrieves a value from the session."""
+        if self.__in_header(key):
+            self._accessed = True
+            return self.header.get(key, default)
         self.ensure_data_loaded()
         return self.data.get(key, default)
 
     def has_key(self, key):
         """Returns True if key is set."""
-        self.ensure_data_loaded()
-        return key in self.data
+        return key in self
 
     def pop(self, key, default=None):
         """Removes key and returns its value, or default if key is not present."""
         self.ensure_data_loaded()
-        self.dirty = True
+        self.__mark_dirty(key)
         return self.data.pop(key, default)
 
     def pop_quick(self, key, default=None):
@@ -382,6 +547,7 @@ class Session(object):
         self.ensure_data_loaded()
         if self.dirty is False:
             self.dirty = Session.DIRTY_BUT_DONT_PERSIST_TO_DB
+        self.dirty_keys.add(key)
         return self.data.pop(key, default)
 
     def set_quick(self, key, value):
@@ -395,6 +561,9 @@ class Session(object):
 
     def __getitem__(self, key):
         """Returns the value associated with key on this session."""
+        if self.__in_header(key):
+            self._accessed = True
+            return self.header.__getitem__(key)
         self.ensure_data_loaded()
         return self.data.__getitem__(key)
 
@@ -405,13 +574,13 @@ class Session(object):
         if not self.sid:
             self.start()
         self.data.__setitem__(key, value)
-        self.dirty = True
+        self.__mark_dirty(key)
 
     def __delitem__(self, key):
         """Deletes the value associated with key on this session."""
         self.ensure_data_loaded()
         self.data.__delitem__(key)
-        self.dirty = True
+        self.__mark_dirty(key)
 
     def __iter__(self):
         """Returns an iterator over the keys (names) of the stored values."""
@@ -420,6 +589,9 @@ class Session(object):
 
     def __contains__(self, key):
         """Returns True if key is present on this session."""
+        if self.__in_header(key):
+            self._accessed = True
+            return self.header.__contains__(key)
         self.ensure_data_loaded()
         return self.data.__contains__(key)
 
@@ -452,12 +624,18 @@ class SessionMiddleware(object):
     threshold, then session data is kept only in a secure cookie.  This avoids
     memcache/datastore latency which is critical for small sessions.  Larger
     sessions are kept in memcache+datastore instead.  Defaults to 10KB.
+
+    ``datastore_write_interval`` - Seconds between datastore writes of a
+    session which changes on every request.  Skipped writes are not repeated,
+    so only use this if losing the latest changes together with memcache is
+    acceptable.  Defaults to 0, which writes on every change.
     """
-    def __init__(self, app, cookie_key, lifetime=DEFAULT_LIFETIME, no_datastore=False, cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH, ignore_paths=None):
+    def __init__(self, app, cookie_key, lifetime=DEFAULT_LIFETIME, no_datastore=False, cookie_only_threshold=DEFAULT_COOKIE_ONLY_THRESH, ignore_paths=None, datastore_write_interval=DEFAULT_DATASTORE_WRITE_INTERVAL):
         self.app = app
         self.lifetime = lifetime
         self.no_datastore = no_datastore
         self.cookie_only_thresh = cookie_only_threshold
+        self.datastore_write_interval = datastore_write_interval
         self.cookie_key = cookie_key
         self.ignore_paths = ignore_paths
         if not self.cookie_key:
@@ -469,7 +647,7 @@ class SessionMiddleware(object):
 
     def __call__(self, environ, start_response):
         # initialize a session for the current user
-        _tls.current_session = Session(lifetime=self.lifetime, no_datastore=self.no_datastore, cookie_only_threshold=self.cookie_only_thresh, cookie_key=self.cookie_key)
+        _tls.current_session = Session(lifetime=self.lifetime, no_datastore=self.no_datastore, cookie_only_threshold=self.cookie_only_thresh, cookie_key=self.cookie_key, datastore_write_interval=self.datastore_write_interval)
 
         # create a hook for us to insert a cookie into the response headers
         def my_start_response(status, headers, exc_info=None):
@@ -482,7 +660,10 @@ class SessionMiddleware(object):
                 return start_response(status, headers, exc_info)
 
         # let the app do its thing
-        return self.app(environ, my_start_response)
+        try:
+            return self.app(environ, my_start_response)
+        finally:
+            _tls.current_session.wait()  # the datastore write started in save()
 
 
 class DjangoSessionMiddleware(object):
@@ -11,6 +11,8 @@ from __future__ import unicode_literals
 import cgitb
 import logging
 import os
+import time
+import zlib
 
 import google.appengine.api.datastore_errors
 import google.appengine.api.urlfetch_errors
@@ -27,10 +29,18 @@ import webapp2
 from gaetk2 import exc
 from gaetk2.config import gaetkconfig
 from gaetk2.config import is_development
+from gaetk2.routing import IndexedRouter
+from gaetk2.tools import metrics
+from gaetk2.tools import sentry
 from gaetk2.tools.sentry import sentry_client
 from webapp2 import Route
 
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 __all__ = ['WSGIApplication', 'Route']
 
 LOGGER = logging.getLogger(__name__)
@@ -38,6 +48,32 @@ LOGGER.addHandler(logging.NullHandler())
 LOGGER.setLevel(logging.INFO)
 
 
+class _StreamingAppIter(object):
+    """Keep the webapp2 request context active while a streaming body is generated.
+
+    :meth:`WSGIApplication.__call__` has already returned when the WSGI server
+    iterates over the body. Templates rendered during that time still expect
+    :func:`webapp2.get_request` to work.
+    """
+
+    def __init__(self, app, request, app_iter):
+        self.app = app
+        self.request = request
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        self.app.set_globals(app=self.app, request=self.request)
+        try:
+            for chunk in self.app_iter:
+                yield chunk
+        finally:
+            self.app.clear_globals()
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
 # Das fängt leider kein runtime.DeadlineExceededError
 class WSGIApplication(webapp2.WSGIApplication):
     """Overwrite exception handling.
@@ -46,14 +82,41 @@ class WSGIApplication(webapp2.WSGIApplication):
     http://webapp2.readthedocs.io/en/latest/api/webapp2.html#webapp2.WSGIApplication
     """
 
+    # only try routes which can possibly match, see `gaetk2.routing`
+    router_class = IndexedRouter
+
     # see https://github.com/GoogleCloudPlatform/webapp2/issues/69
     allowed_methods = frozenset(
         ('GET', 'POST', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE', 'PATCH')
     )
 
+    # count requests, errors and latencies per route, see `gaetk2.tools.metrics`
+    collect_request_stats = True
+
+    # POST bodies sent to Sentry are cut to this many bytes
+    sentry_max_body_size = 16 * 1024
+
+    # see `compress_response()`
+    compress_responses = True
+    compress_min_size = 1024
+    compress_level = 6
+    compress_types = frozenset((
+        'application/javascript',
+        'application/json',
+        'application/xml',
+        'image/svg+xml',
+        'text/css',
+        'text/csv',
+        'text/html',
+        'text/javascript',
+        'text/plain',
+        'text/xml',
+    ))
+
     @ndb.toplevel
     def __call__(self, environ, start_response):
         LOGGER.debug('WSGI __call__ starting', extra={'environ': environ})
+        start = time.time()
 
         with self.request_context_class(self, environ) as (request, response):
             # context = ndb.get_context()
@@ -68,9 +131,8 @@ class WSGIApplication(webapp2.WSGIApplication):
                         rv = self.router.dispatch(request, response)
                     except exc.HTTP404_NotFound:
                         # some extra logging to find non matching routes
-                        LOGGER.info('NotFound: %r', self)
-                        LOGGER.info('router: %r', vars(self.router))
-                        LOGGER.info('environ: %r', environ)
+                        if hasattr(self.router, 'describe_miss'):
+                            LOGGER.info('NotFound: %s', self.router.describe_miss(request))
                         raise
                     if rv is not None:
                         response = rv
@@ -108,6 +170,14 @@ class WSGIApplication(webapp2.WSGIApplication):
 
                 try:
                     self.fix_unicode_headers(response)
+                    app_iter = getattr(response, 'app_iter', None)
+                    if app_iter is not None and not isinstance(app_iter, (list, tuple)):
+                        # streaming response, see `BasicHandler.streaming_render`
+                        response.app_iter = _StreamingAppIter(self, request, app_iter)
+                    if self.compress_responses:
+                        self.compress_response(request, response)
+                    if self.collect_request_stats:
+                        self.count_request(request, response, time.time() - start)
                     return response(environ, start_response)
                 except BaseException as e:
                     LOGGER.info('_internal_error')
@@ -395,22 +465,91 @@ class WSGIApplication(webapp2.WSGIApplication):
         """
         # Its not well documented how to structure the data for sentry
         # https://gist.github.com/cgallemore/4507616
+        # Most requests never send anything to Sentry so we only provide
+        # functions which are called when an event is actually sent.
+        sentry.breadcrumbs.clear()
+        sentry_client.lazy_context('user', lambda: self._get_sentry_user(request))
+        sentry_client.lazy_context('extra', lambda: self._get_sentry_extra(request))
+        sentry_client.lazy_context('http', lambda: self._get_sentry_http(request))
+
+        # some are set in sentry.py
+        tags = {
+            # 'git_commit': 'c0deb10c4'
+        }
+        # HTTP_X_CLOUD_TRACE_CONTEXT  301334dd3fca3fe29d8625c3a3a115f7/13580140575625565538;o=1
+        # REQUEST_ID_HASH 7DB846CB    <type 'str'>
+        # REQUEST_LOG_ID  5a5f0ce100ff0c90937db846cb0001737e6412d332d6733343630326234000100
+        # INSTANCE_ID
+        # SERVER_SOFTWARE
+        # AUTH_DOMAIN
+        # PATH_TRANSLATED SCRIPT_NAME PATH_INFO
+        # HTTP_X_GOOGLE_APPS_METADATA
+        # interesting environment variables - see https://david-buxton-test.appspot.com/env#:
+        varnames = 'CURRENT_NAMESPACE INBOUND_APPID QUEUENAME TASKRETRYREASON'
+        for name in varnames.split():
+            fullname = 'HTTP_X_APPENGINE_' + name
+            if request.environ.get(fullname):
+                tags['GAE_' + name] = os.environ.get(fullname)
+        sentry_client.tags_context(tags)
 
-        # see https://docs.sentry.io/clientdev/interfaces/user/
+    def compress_response(self, request, response):
+        """Compress the body of `response` with gzip or brotli if the client accepts it.
+
+        Only responses with a content type in :attr:`compress_types` and
+        bodies of at least :attr:`compress_min_size` bytes are compressed.
+        Streaming responses are compressed while they are sent. Brotli is used
+        if the ``brotli`` module is available and the client prefers it.
+        """
+        if request.method == 'HEAD' or not hasattr(response, 'app_iter'):
+            return
+        if response.status_int < 200 or response.status_int in (204, 304):
+            return
+        if response.content_type not in self.compress_types:
+            return
+        # the response depends on `Accept-Encoding` even if we don't compress
+        vary = response.headers.get(b'Vary', b'')
+        if b'accept-encoding' not in vary.lower():
+            response.headers[b'Vary'] = b', '.join(filter(None, [vary, b'Accept-Encoding']))
+        if response.headers.get(b'Content-Encoding'):
+            return
+        coding = _choose_encoding(request.headers.get('Accept-Encoding', ''))
+        if not coding:
+            return
+
+        if isinstance(response.app_iter, (list, tuple)):
+            body = response.body
+            if len(body) < self.compress_min_size:
+                return
+            if coding == 'br':
+                response.body = brotli.compress(body, quality=self.compress_level)
+            else:
+                compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                response.body = compressor.compress(body) + compressor.flush()
+        else:
+            response.app_iter = _compress_iter(response.app_iter, coding, self.compress_level)
+            response.content_length = None
+        response.headers[b'Content-Encoding'] = coding.encode('ascii')
+        etag = response.headers.get(b'ETag')
+        if etag and not etag.startswith(b'W/'):
+            # the compressed body is a different representation
+            response.headers[b'ETag'] = b'W/' + etag
+
+    def _get_sentry_user(self, request):
+        """Sentry user context, see https://docs.sentry.io/clientdev/interfaces/user/."""
         env = request.environ
-        sentry_client.user_context(
-            {
-                'ip_address': env.get('REMOTE_ADDR'),
-                'email': env.get('USER_EMAIL'),
-                'id': env.get('USER_ID'),
-                'username': env.get(
-                    'USER_NICKNAME', env.get('HTTP_X_APPENGINE_INBOUND_APPID')
-                ),
-                # HTTP_X_APPENGINE_CRON   true
-                # USER_ORGANIZATION USER_IS_ADMIN
-            }
-        )
+        return {
+            'ip_address': env.get('REMOTE_ADDR'),
+            'email': env.get('USER_EMAIL'),
+            'id': env.get('USER_ID'),
+            'username': env.get(
+                'USER_NICKNAME', env.get('HTTP_X_APPENGINE_INBOUND_APPID')
+            ),
+            # HTTP_X_APPENGINE_CRON   true
+            # USER_ORGANIZATION USER_IS_ADMIN
+        }
 
+    def _get_sentry_extra(self, request):
+        """Additional information for Sentry."""
         extra = {}
         for name in 'HTTP_REFERER HTTP_USER_AGENT'.split():
             if os.environ.get(name):
@@ -424,7 +563,6 @@ class WSGIApplication(webapp2.WSGIApplication):
                 extra[attr] = request.get(attr)
             except Exception:
                 LOGGER.exception('problem parsing %s', attr)
-        sentry_client.extra_context(extra)
         # server_name: the hostname of the server
         # os.environ.get('SERVER_NAME', '')
         # data[:release] = @release if @release
@@ -434,7 +572,10 @@ class WSGIApplication(webapp2.WSGIApplication):
         # data['release'] = self.release
         # data['culprit'] = culprit
         # self.repos = self._format_repos(o.get('repos'))
+        return extra
 
+    def _get_sentry_http(self, request):
+        """Sentry http context, see https://docs.sentry.io/clientdev/interfaces/http/."""
         http = {
             'url': request.url,
             # 'query_string': request.query_string, - read by reaven vrom the environment
@@ -444,33 +585,66 @@ class WSGIApplication(webapp2.WSGIApplication):
             'env': request.environ,
         }
         if request.method in ['POST', 'PUT', 'PATCH']:
-            http['data'] = {'raw': request.body}
-
-        # see also https://docs.sentry.io/clientdev/interfaces/http/
-        sentry_client.http_context(http)
-
-        # some are set in sentry.py
-        tags = {
-            # 'git_commit': 'c0deb10c4'
-        }
-        # HTTP_X_CLOUD_TRACE_CONTEXT  301334dd3fca3fe29d8625c3a3a115f7/13580140575625565538;o=1
-        # REQUEST_ID_HASH 7DB846CB    <type 'str'>
-        # REQUEST_LOG_ID  5a5f0ce100ff0c90937db846cb0001737e6412d332d6733343630326234000100
-        # INSTANCE_ID
-        # SERVER_SOFTWARE
-        # AUTH_DOMAIN
-        # PATH_TRANSLATED SCRIPT_NAME PATH_INFO
-        # HTTP_X_GOOGLE_APPS_METADATA
-        # interesting environment variables - see https://david-buxton-test.appspot.com/env#:
-        varnames = 'CURRENT_NAMESPACE INBOUND_APPID QUEUENAME TASKRETRYREASON'
-        for name in varnames.split():
-            fullname = 'HTTP_X_APPENGINE_' + name
-            if request.environ.get(fullname):
-                tags['GAE_' + name] = os.environ.get(fullname)
-        sentry_client.tags_context(tags)
+            body = request.body
+            if len(body) > self.sentry_max_body_size:
+                body = '{}... [{} bytes truncated]'.format(
+                    body[:self.sentry_max_body_size].decode('utf-8', 'replace'),
+                    len(body) - self.sentry_max_body_size)
+            http['data'] = {'raw': body}
+        return http
+
+    def count_request(self, request, response, duration):
+        """Record request statistics, see :func:`gaetk2.tools.metrics.count_request`."""
+        try:
+            route = getattr(request.route, 'template', None) or '(no route)'
+            metrics.count_request(
+                '{} {}'.format(request.method, route), response.status_int, duration)
+        except Exception:
+            LOGGER.info('could not count request', exc_info=True)
 
     def fix_unicode_headers(self, response):
         """Ensure all Headers are Unicode."""
         if hasattr(response, 'headers'):
             for name, val in response.headers.items():
                 response.headers[str(name)] = str(val)
+
+
+def _choose_encoding(accept_encoding):
+    """Return `'br'`, `'gzip'` or `None` based on the `Accept-Encoding` header."""
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip()] = quality
+    if brotli is not None and accepted.get('br', 0) > 0 and accepted['br'] >= accepted.get('gzip', 0):
+        return 'br'
+    if accepted.get('gzip', accepted.get('*', 0)) > 0:
+        return 'gzip'
+    return None
+
+
+def _compress_iter(app_iter, coding, level):
+    """Compress a streaming body chunk by chunk."""
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        for chunk in app_iter:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in app_iter:
+            # flush so the client gets something for every chunk
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    if hasattr(app_iter, 'close'):
+        app_iter.close()
@@ -23,6 +23,7 @@ gaetkconfig = _gaetk_registry.register(
     dict(
         SECRET='',  # needed for everything
         TEMPLATE_DIRS=['./templates'],
+        TEMPLATE_COMPILED_DIR='./templates_compiled',  # see bin/build_code.py
         # auth
         JWT_SECRET_KEY=None,
         JWT_AUDIENCE=None,
@@ -41,7 +42,16 @@ gaetkconfig = _gaetk_registry.register(
         SENTRY_DSN='',
         SENTRY_PUBLIC_DSN='',
         SENTRY_SECURITY_TOKEN='',
+        SENTRY_TRANSPORT='http',  # or 'taskqueue' or 'file', see gaetk2.tools.sentry
+        SENTRY_QUEUE='sentry',  # pull queue used by SENTRY_TRANSPORT='taskqueue'
+        SENTRY_FILE='sentry_events.jsonl',  # used by SENTRY_TRANSPORT='file'
         INBOUND_APP_IDS=[],
+        # sampling profiler, see gaetk2.tools.profiler
+        # both settings register requests with a single helper thread per instance:
+        # BUDGET_MS every request, SAMPLE_RATE one in N requests
+        PROFILER_BUDGET_MS=0,  # profile requests taking longer than this, 0 disables
+        PROFILER_SAMPLE_RATE=0,  # profile one in N requests, 0 disables
+        PROFILER_INTERVAL_MS=10,
     )
 )
 
@@ -8,6 +8,10 @@ Copyright (c) 2010-2019 HUDORA. All rights reserved.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import calendar
+import datetime
+import email.utils
+import hashlib
 import inspect
 import logging
 import os
@@ -24,13 +28,18 @@ import jinja2
 import webapp2
 
 from gaetk2 import exc
-from gaetk2 import jinja_filters
+from gaetk2 import templating
 from gaetk2.config import gaetkconfig
 from gaetk2.config import get_release
 from gaetk2.config import is_development
 from gaetk2.config import is_production
 from gaetk2.tools import hujson2
 from gaetk2.tools import introspection
+from gaetk2.tools import metrics
+from gaetk2.tools import profiler
+from gaetk2.tools.caching import TwoTierCache
+from gaetk2.tools.lazy import LazyValue
+from gaetk2.tools.lazy import resolve_dict
 from gaetk2.tools.sentry import sentry_client
 
 
@@ -44,6 +53,9 @@ except:
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 _jinja_env_cache = None
+# (handler class, hook name) -> hooks to call, see `BasicHandler._get_hook_chain()`
+_hook_chain_cache = {}
+_response_cache = TwoTierCache('gaetk2_response_cache', maxsize=200)
 
 # Your app usually will extend a `BasicHandler` or `DefaultHandler`
 # (for added authentication). These based on
@@ -78,6 +90,21 @@ class BasicHandler(webapp2.RequestHandler):
         session: current session which is based on https://github.com/dound/gae-sessions.
         default_cachingtime (None or int): Class Variable. Which cache headers to generate,
             see :meth:`_set_cache_headers`.
+        response_cache_ttl (None or int): Class Variable. Cache complete responses to
+            `GET` requests for this many seconds, see :meth:`get_response_cache_key`.
+        response_cache_per_credential (boolean): Class Variable. Also cache responses
+            for logged in users (per `credential.uid`). Otherwise only anonymous
+            requests are cached.
+        response_cache_vary (tuple): Class Variable. Request headers which influence
+            the response, e.g. ``('Accept-Language',)``.
+        generate_etag (boolean): Class Variable. Add an `ETag` header based on the
+            response body and answer conditional requests with `304 Not Modified`.
+            Off by default because it hashes every `GET` response.
+            See :meth:`get_content_version` for a cheaper way.
+        streaming_render (boolean): Class Variable. :meth:`render` does not buffer
+            the page but sends it in chunks of `stream_chunk_size` bytes while the
+            template is rendered. Useful for big list pages. The template is
+            rendered after the session was saved, so it must not change the session.
 
     Note:
         gaetk2 adds various variables to the template context. Other mixins provide
@@ -130,12 +157,24 @@ class BasicHandler(webapp2.RequestHandler):
     """
 
     default_cachingtime = None
+    response_cache_ttl = None
+    response_cache_per_credential = False
+    response_cache_vary = ()
+    generate_etag = False
+    streaming_render = False
+    stream_chunk_size = 32 * 1024
 
     def __init__(self, *args, **kwargs):
         """Initialize RequestHandler."""
         self.credential = None
         self.session = {}
         self._last_template_exception = None
+        self._gaetk_trace = None
+        self._gaetk_timer = metrics.PhaseTimer()
+        self._gaetk_profile = None
+        self._gaetk_response_cache = None
+        self._gaetk_validators = None
+        self._gaetk_context = None  # output of the `build_context` chain of `render()`
         # Careful! `webapp2.RequestHandler` does not call super()!
         super(BasicHandler, self).__init__(*args, **kwargs)
         # ... so we route arround that
@@ -229,9 +268,9 @@ class BasicHandler(webapp2.RequestHandler):
 
         """
         start = time.time()
-        self._render_to_fd(values, template_name, self.response.out)
+        self._render_to_fd(values, template_name, self.response.out, stream=self.streaming_render)
         delta = time.time() - start
-        if delta > 500:
+        if delta > 0.5:
             LOGGER.warn('rendering took %d ms', (delta * 1000.0))
 
     def return_text(
@@ -264,18 +303,39 @@ class BasicHandler(webapp2.RequestHandler):
             myvalues = dict(navsection='kunden', ...)
             myvalues.update(values)
             return myvalues
+
+        Values which are expensive to compute and not used by all templates
+        should be wrapped in :class:`~gaetk2.tools.lazy.LazyValue`. They
+        are only computed if the template uses them.
         """
         ret = {
             'request': self.request,
             'credential': self.credential,
             'gaetk_logout_url': '/gaetk2/auth/logout',
             'gaetk_path': self.request.path,
-            'is_staff': self.is_staff(),
-            'is_sysadmin': self.is_sysadmin(),
+            'is_staff': LazyValue(self.is_staff),
+            'is_sysadmin': LazyValue(self.is_sysadmin),
         }
         ret.update(values)
         return ret
 
+    def build_fragment_context(self, values):
+        """Return the context for rendering a template fragment during a request.
+
+        Used by mixins rendering parts of a page, like
+        :meth:`~gaetk2.handlers.mixins.paginate.PaginateMixin.get_paginator_template`.
+        If :meth:`render` was already called during this request, its context
+        (including already computed :class:`~gaetk2.tools.lazy.LazyValue`
+        instances) is reused and `values` are added on top - they win over
+        values from the :meth:`build_context` chain. Otherwise `values` are
+        passed through the chain like in :meth:`render`.
+        """
+        if self._gaetk_context is None:
+            return self._reduce_all_inherited('build_context', values)
+        ret = dict(self._gaetk_context)
+        ret.update(values)
+        return ret
+
     def _add_jinja2env_globals(self, env):
         """Helper to provide additional Globals to Jinja2 Environment.
 
@@ -384,20 +444,18 @@ class BasicHandler(webapp2.RequestHandler):
         global _jinja_env_cache
 
         if not _jinja_env_cache:
-            env = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(gaetkconfig.TEMPLATE_DIRS),
-                auto_reload=False,  # unneeded on App Engine production
-                trim_blocks=True,  # first newline after a block is removed
-                # lstrip_blocks=True,
-                bytecode_cache=jinja2.MemcachedBytecodeCache(memcache, timeout=3600),
-                # This needs jinja2 > Version 2.8
-                autoescape=jinja2.select_autoescape(['html', 'xml']),
+            # templates precompiled by `bin/build_code.py` are
+            # used unless we are in development
+            loader = templating.get_loader(
+                gaetkconfig.TEMPLATE_DIRS,
+                gaetkconfig.TEMPLATE_COMPILED_DIR,
+                use_compiled=not is_development(),
+            )
+            env = templating.create_environment(
+                loader,
+                bytecode_cache=templating.LayeredBytecodeCache(memcache, release=get_release()),
             )
-
             env.exception_handler = self._jinja2_exception_handler
-
-            jinja_filters.register_custom_filters(env)
-            env.policies['json.dumps_function'] = hujson2.htmlsafe_json_dumps
             env = self._add_jinja2env_globals(env)
             _jinja_env_cache = env
 
@@ -418,14 +476,17 @@ class BasicHandler(webapp2.RequestHandler):
         sentry_client.captureException(exc_info=traceback.exc_info)
         self._last_template_exception = traceback.exc_info[1]
 
-    def _render_to_fd(self, values, template_name, fd):
+    def _render_to_fd(self, values, template_name, fd, stream=False):
         """Sends the rendered content of a Jinja2 Template to Output.
 
         Per default the template is provided with output of ``build_context(values)``.
+        If `stream` is set, the template is rendered while the response is
+        sent to the client instead of writing to `fd`.
         """
         env = self.get_jinja2env()
         try:
-            template = env.get_template(template_name)
+            with self._gaetk_timer.phase('template_load'):
+                template = env.get_template(template_name)
         except jinja2.TemplateNotFound:
             # better error reporting - we want to see the name of the base template
             raise jinja2.TemplateNotFound(template_name)
@@ -444,25 +505,39 @@ class BasicHandler(webapp2.RequestHandler):
         # to collect template variables from all Parent-Classes and MisIns.
         # this keeps parents from having all to implement the function and
         # use `super()`
-        values = self._reduce_all_inherited('build_context', values)
+        with self._gaetk_timer.phase('build_context'):
+            values = self._reduce_all_inherited('build_context', values)
+        # reused by `build_fragment_context()`
+        self._gaetk_context = values
 
         # for debugging provide access to all variables if `_gaetk_dump` is
         # given in the URL
-        if self.is_sysadmin() and self.request.get('_gaetk_dump'):
+        if self.request.get('_gaetk_dump') and self.is_sysadmin():
             self.body = ''
             self.response.headers['Content-Type'] = 'application/json'
             fd.write(
                 hujson2.htmlsafe_json_dumps(
                     {
                         'gaetk_globalcontext_json': env.globals,
-                        'gaetk_localcontext_json': values,
+                        'gaetk_localcontext_json': resolve_dict(values),
                     }
                 )
             )
             return None
 
+        if stream:
+            # The template is rendered after `dispatch()` returned and the
+            # session was saved. Lazy values (e.g. `_gaetk_messages`, which
+            # expires messages in the session) have to be computed now.
+            values = resolve_dict(values)
+            self.response.app_iter = self._iter_chunks(env, template.generate(values))
+            # we don't know the length in advance
+            self.response.content_length = None
+            return None
+
         try:
-            template.stream(values).dump(fd, encoding='utf-8')
+            with self._gaetk_timer.phase('render'):
+                template.stream(values).dump(fd, encoding='utf-8')
             # we do not want to rely on webob.Response magically transforming unicode
         except jinja2.TemplateNotFound:  # can happen for includes etc.
             # better error reporting
@@ -479,6 +554,45 @@ class BasicHandler(webapp2.RequestHandler):
         # parsed_content = env.parse(template_source)
         # meta.find_undeclared_variables(parsed_content)
 
+    def _iter_chunks(self, env, generator):
+        """Encode the output of `template.generate()` and yield it in chunks.
+
+        This runs after :meth:`dispatch` has finished while
+        :class:`~gaetk2.application.WSGIApplication` sends the response.
+        So the rendering time is neither in the phase timings nor in
+        profiles and changes to the session are lost.
+        """
+        chunk_size = self.stream_chunk_size
+        buf = []
+        size = 0
+        start = time.time()
+        try:
+            for part in generator:
+                part = part.encode('utf-8')
+                buf.append(part)
+                size += len(part)
+                if size >= chunk_size:
+                    yield b''.join(buf)
+                    buf = []
+                    size = 0
+        except jinja2.TemplateNotFound:  # can happen for includes etc.
+            LOGGER.info('template dirs: %s', gaetkconfig.TEMPLATE_DIRS)
+            raise
+        except Exception:
+            # the status line is already sent, so there is not much we can do
+            LOGGER.exception('error while streaming template')
+            sentry_client.captureException()
+            raise
+        if buf:
+            yield b''.join(buf)
+        delta = time.time() - start
+        if delta > 0.5:
+            LOGGER.warn('streaming took %d ms', (delta * 1000.0))
+        if getattr(self.session, 'dirty', False):
+            LOGGER.error(
+                'session changed while streaming %s - changes are lost, '
+                'set streaming_render = False', self.request.path)
+
     def _set_cache_headers(self, caching_time=None):
         """Set Cache Headers.
 
@@ -499,6 +613,27 @@ class BasicHandler(webapp2.RequestHandler):
             elif ct <= 0:
                 self.response.headers[b'Cache-Control'] = b'no-cache public'
 
+    @classmethod
+    def _get_hook_chain(cls, funcname):
+        """Return `funcname` as found in the `__dict__` of all SuperClasses.
+
+        The chain is computed once per class and then cached. Entries are
+        `(class, attribute)` tuples in reversed MRO order, the attributes are
+        still unbound.
+        """
+        key = (cls, funcname)
+        chain = _hook_chain_cache.get(key)
+        if chain is None:
+            # This code is based in ideas from Guido van Rossum, see
+            # https://www.python.org/download/releases/2.2/descrintro/#cooperation
+            chain = tuple(
+                (klass, klass.__dict__[funcname])
+                for klass in reversed(cls.__mro__)
+                if funcname in klass.__dict__
+            )
+            _hook_chain_cache[key] = chain
+        return chain
+
     def _call_all_inherited(self, funcname, *args, **kwargs):
         """In all SuperClasses call `funcname` - if it exists."""
         # We don't want to burden all mixins with implementing
@@ -508,24 +643,29 @@ class BasicHandler(webapp2.RequestHandler):
         # it also reverses the call order
 
         self._debug_callstack = []
-        # This code is based in ideas from Guido van Rossum, see
-        # https://www.python.org/download/releases/2.2/descrintro/#cooperation
-        for cls in reversed(self.__class__.__mro__):
-            if funcname in cls.__dict__:
-                x = cls.__dict__[funcname]
-                if hasattr(x, '__get__'):
-                    x = x.__get__(self)
-                if callable(x):
-                    self._debug_callstack.append(x)
-                    LOGGER.debug(
-                        'calling %s.%s(*%r, **%r)', cls, funcname, args, kwargs
+        for cls, x in self._get_hook_chain(funcname):
+            if hasattr(x, '__get__'):
+                x = x.__get__(self)
+            if callable(x):
+                self._debug_callstack.append(x)
+                if self._gaetk_trace is not None:
+                    start = time.time()
+                try:
+                    x(*args, **kwargs)
+                except TypeError as e:
+                    e.message = '{} while calling {}.{}(*{!r}, **{!r})'.format(
+                        str(e), cls, funcname, args, kwargs
                     )
-                    try:
-                        x(*args, **kwargs)
-                    except TypeError as e:
-                        e.message = '{} while calling {}.{}(*{!r}, **{!r})'.format(
-                            str(e), cls, funcname, args, kwargs
-                        )
+                    LOGGER.exception(
+                        'failure calling %s.%s(*%r, **%r)',
+                        cls,
+                        funcname,
+                        args,
+                        kwargs,
+                    )
+                    raise e
+                except BaseException as e:
+                    if not isinstance(e, exc.HTTPException):
                         LOGGER.exception(
                             'failure calling %s.%s(*%r, **%r)',
                             cls,
@@ -533,19 +673,12 @@ class BasicHandler(webapp2.RequestHandler):
                             args,
                             kwargs,
                         )
-                        raise e
-                    except BaseException as e:
-                        if not isinstance(e, exc.HTTPException):
-                            LOGGER.exception(
-                                'failure calling %s.%s(*%r, **%r)',
-                                cls,
-                                funcname,
-                                args,
-                                kwargs,
-                            )
-                        raise
-                else:
-                    LOGGER.warn('not clallable: %r', x)
+                    raise
+                finally:
+                    if self._gaetk_trace is not None:
+                        self._gaetk_trace.append((funcname, cls.__name__, time.time() - start))
+            else:
+                LOGGER.warn('not clallable: %r', x)
 
     def _reduce_all_inherited(self, funcname, initial):
         """In all SuperClasses call `funcname` with the output of the previus call."""
@@ -556,26 +689,27 @@ class BasicHandler(webapp2.RequestHandler):
         # it also reverses the call order
 
         ret = initial
-        # This code is based in ideas from Guido van Rossum, see
-        # https://www.python.org/download/releases/2.2/descrintro/#cooperation
-        for cls in reversed(self.__class__.__mro__):
-            if funcname in cls.__dict__:
-                x = cls.__dict__[funcname]
-                if hasattr(x, '__get__'):
-                    x = x.__get__(self)
-                if callable(x):
-                    LOGGER.debug('reducing %s.%s(%r)', cls, funcname, ret)
-                    try:
-                        ret = x(ret)
-                    except:
-                        LOGGER.debug('error reducing %s.%s(%r)', cls, funcname, ret)
-                        raise
-                else:
-                    LOGGER.warn('not callable: %r', x)
-                if ret is None:
-                    raise RuntimeError(
-                        '{}.{} did not provide a return value'.format(cls, funcname)
-                    )
+        for cls, x in self._get_hook_chain(funcname):
+            if hasattr(x, '__get__'):
+                x = x.__get__(self)
+            if callable(x):
+                if self._gaetk_trace is not None:
+                    start = time.time()
+                try:
+                    ret = x(ret)
+                except:
+                    # no `repr(ret)` here - the template context can be huge
+                    LOGGER.debug('error reducing %s.%s', cls, funcname)
+                    raise
+                finally:
+                    if self._gaetk_trace is not None:
+                        self._gaetk_trace.append((funcname, cls.__name__, time.time() - start))
+            else:
+                LOGGER.warn('not callable: %r', x)
+            if ret is None:
+                raise RuntimeError(
+                    '{}.{} did not provide a return value'.format(cls, funcname)
+                )
         return ret
 
     def dispatch(self):
@@ -614,61 +748,304 @@ class BasicHandler(webapp2.RequestHandler):
             # probably session middleware not loaded
             self.session = {}
 
-        if str(self.session) != 'uninitialized session':
+        # don't use `str(self.session)`, it would load session data from the backend
+        if hasattr(self.session, 'is_active') and self.session.is_active():
+            # `data` is `None` if only the cookie header is loaded yet
+            session_data = getattr(self.session, 'data', None)
+            if session_data is None:
+                session_data = getattr(self.session, 'header', None)
             sentry_client.note(
-                'storage', 'Session loaded', data=dict(session=self.session)
+                'storage', 'Session loaded', data=dict(session=session_data)
             )
 
+        # decide once per request if we record hook timings
+        if LOGGER.isEnabledFor(logging.DEBUG) or self.request.GET.get('_gaetk_trace'):
+            self._gaetk_trace = []
+
+        timer = self._gaetk_timer
+        timer.activate()
+        # whatever happens below, stop sampling and counting RPCs for this request
         try:
-            self._call_all_inherited(
-                'pre_authentication_hook', method_name, *args, **kwargs
-            )
-            self._call_all_inherited(
-                'authentication_preflight_hook', method_name, *args, **kwargs
-            )
-            self._call_all_inherited(
-                'authentication_hook', method_name, *args, **kwargs
-            )
-            self._call_all_inherited('authorisation_hook', method_name, *args, **kwargs)
-            self._call_all_inherited(
-                'method_preperation_hook', method_name, *args, **kwargs
-            )
-            try:
-                response = method(*args, **kwargs)
-            except TypeError:
-                # parameter missmatch is the error we see most often
-                # so help to pin down where it happens
-                klass = introspection.get_class_that_defined_method(method)
-                methname = method.__name__
-                sourcepos = '{}:{}'.format(
-                    os.path.basename(method.__func__.__code__.co_filename),
-                    method.__func__.__code__.co_firstlineno,
+            if gaetkconfig.PROFILER_BUDGET_MS or gaetkconfig.PROFILER_SAMPLE_RATE:
+                self._gaetk_profile = profiler.start(
+                    self._get_metrics_route(),
+                    budget=gaetkconfig.PROFILER_BUDGET_MS / 1000.0,
+                    sample_rate=gaetkconfig.PROFILER_SAMPLE_RATE,
+                    interval=gaetkconfig.PROFILER_INTERVAL_MS / 1000.0,
                 )
-                LOGGER.debug(
-                    'method called: %s.%s(%r) from %s',
-                    klass.__name__,
-                    methname,
-                    (args, kwargs),
-                    sourcepos,
-                )
-                LOGGER.debug('defined at: %s %s', klass, sourcepos)
-                raise
-            response = self.response_overwrite(response, method, *args, **kwargs)
-        except exc.HTTPException as e:
-            # for HTTP exceptions execute `finished_hooks`
-            if e.code < 500:
-                self._call_all_inherited('finished_hook', method_name, *args, **kwargs)
-            return self.handle_exception(e, self.app.debug)
-        except BaseException as e:
-            return self.handle_exception(e, self.app.debug)
-
-        if response and not getattr(self, '_gaetk2_allow_strange_responses', False):
-            assert isinstance(response, webapp2.Response)
-
-        self._set_cache_headers()
-        self._call_all_inherited('finished_hook', method_name, *args, **kwargs)
-        self.finished_overwrite(response, method, *args, **kwargs)
-        return response
+            try:
+                with timer.phase('authentication'):
+                    self._call_all_inherited(
+                        'pre_authentication_hook', method_name, *args, **kwargs
+                    )
+                    self._call_all_inherited(
+                        'authentication_preflight_hook', method_name, *args, **kwargs
+                    )
+                    self._call_all_inherited(
+                        'authentication_hook', method_name, *args, **kwargs
+                    )
+                with timer.phase('authorisation'):
+                    self._call_all_inherited('authorisation_hook', method_name, *args, **kwargs)
+                # authorisation is done, so we might have the response already
+                if self._check_content_version(method_name, *args, **kwargs):
+                    response = None
+                elif self.response_cache_ttl and self._serve_from_response_cache():
+                    response = None
+                else:
+                    with timer.phase('preparation'):
+                        self._call_all_inherited(
+                            'method_preperation_hook', method_name, *args, **kwargs
+                        )
+                    try:
+                        with timer.phase('handler'):
+                            response = method(*args, **kwargs)
+                    except TypeError:
+                        # parameter missmatch is the error we see most often
+                        # so help to pin down where it happens
+                        klass = introspection.get_class_that_defined_method(method)
+                        methname = method.__name__
+                        sourcepos = '{}:{}'.format(
+                            os.path.basename(method.__func__.__code__.co_filename),
+                            method.__func__.__code__.co_firstlineno,
+                        )
+                        LOGGER.debug(
+                            'method called: %s.%s(%r) from %s',
+                            klass.__name__,
+                            methname,
+                            (args, kwargs),
+                            sourcepos,
+                        )
+                        LOGGER.debug('defined at: %s %s', klass, sourcepos)
+                        raise
+                    response = self.response_overwrite(response, method, *args, **kwargs)
+            except exc.HTTPException as e:
+                # for HTTP exceptions execute `finished_hooks`
+                if e.code < 500:
+                    self._call_all_inherited('finished_hook', method_name, *args, **kwargs)
+                self._log_trace(method_name)
+                self._finish_timing(None)
+                return self.handle_exception(e, self.app.debug)
+            except BaseException as e:
+                self._log_trace(method_name)
+                self._finish_timing(None)
+                return self.handle_exception(e, self.app.debug)
+
+            if response and not getattr(self, '_gaetk2_allow_strange_responses', False):
+                assert isinstance(response, webapp2.Response)
+
+            self._set_cache_headers()
+            self._call_all_inherited('finished_hook', method_name, *args, **kwargs)
+            self.finished_overwrite(response, method, *args, **kwargs)
+            if self._gaetk_response_cache:
+                self._store_in_response_cache(response or self.response)
+            self._add_validators(response or self.response)
+            self._log_trace(method_name)
+            self._finish_timing(response or self.response)
+            return response
+        finally:
+            self._stop_timing()
+
+    def get_content_version(self, method_name, *args, **kwargs):
+        """Return something identifying the current version of the content or `None`.
+
+        Overwrite this to allow answering conditional `GET` requests with
+        `304 Not Modified` without calling the HTTP method and rendering. Called
+        with the same parameters as the HTTP method after :meth:`authorisation_hook`.
+        The return value can be a string or number (used for the `ETag`) or a
+        :class:`datetime.datetime` in UTC (used for `ETag` and `Last-Modified`),
+        e.g. the maximum `updated_at` of the entities displayed.
+
+        Example::
+
+            def get_content_version(self, method_name, *args, **kwargs):
+                latest = Article.query().order(-Article.updated_at).get(projection=['updated_at'])
+                return latest.updated_at if latest else None
+
+        """
+        return None
+
+    def _check_content_version(self, method_name, *args, **kwargs):
+        """Answer with `304 Not Modified` if the client has the current content version.
+
+        Returns `True` if `self.response` is a 304 reply.
+        """
+        if self.request.method not in ('GET', 'HEAD'):
+            return False
+        version = self.get_content_version(method_name, *args, **kwargs)
+        if version is None:
+            return False
+        last_modified = None
+        if isinstance(version, datetime.datetime):
+            # HTTP dates have a resolution of one second
+            last_modified = version.replace(microsecond=0, tzinfo=None)
+        uid = self.credential.uid if self.credential is not None else ''
+        etag = 'W/"{}"'.format(hashlib.md5(
+            repr([get_release(), self.request.path_qs, uid, version])).hexdigest())
+        self._gaetk_validators = (etag, last_modified)
+        if not self._is_not_modified(etag, last_modified):
+            return False
+        self.response.status = 304
+        self._set_validator_headers(self.response, etag, last_modified)
+        return True
+
+    def _add_validators(self, response):
+        """Add `ETag` and `Last-Modified` to `response` and turn it into a 304 if possible."""
+        if self.request.method not in ('GET', 'HEAD') or response.status_int != 200:
+            return
+        if self._gaetk_validators:
+            etag, last_modified = self._gaetk_validators
+        elif b'ETag' in response.headers:
+            etag, last_modified = response.headers[b'ETag'], None
+        elif (self.generate_etag and self.request.method == 'GET'
+              and isinstance(response.app_iter, (list, tuple))):
+            etag, last_modified = '"{}"'.format(hashlib.md5(response.body).hexdigest()), None
+        else:
+            return
+        self._set_validator_headers(response, etag, last_modified)
+        if self._is_not_modified(etag, last_modified):
+            response.status = 304
+            response.body = b''
+
+    def _set_validator_headers(self, response, etag, last_modified):
+        response.headers[b'ETag'] = etag.encode('ascii')
+        if last_modified:
+            response.headers[b'Last-Modified'] = email.utils.formatdate(
+                calendar.timegm(last_modified.utctimetuple()), usegmt=True).encode('ascii')
+
+    def _is_not_modified(self, etag, last_modified):
+        """Check `If-None-Match` and `If-Modified-Since` of the request."""
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            # weak comparison, see RFC 7232 section 2.3.2
+            if if_none_match.strip() == '*':
+                return True
+            etag = etag[2:] if etag.startswith('W/') else etag
+            candidates = [tag.strip() for tag in if_none_match.split(',')]
+            return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in candidates)
+        if last_modified and self.request.if_modified_since:
+            return last_modified <= self.request.if_modified_since.replace(tzinfo=None)
+        return False
+
+    def get_response_cache_key(self):
+        """Return the key used for caching the response or `None` if it must not be cached.
+
+        Only used if :attr:`response_cache_ttl` is set. Called after
+        :meth:`authorisation_hook`, so `self.credential` is available.
+        The key is built from the path, query string, the headers listed in
+        :attr:`response_cache_vary` and - if :attr:`response_cache_per_credential`
+        is set - `credential.uid`. Overwrite to add more.
+
+        Be careful with pages containing user specific data like
+        messages from :class:`~gaetk2.handlers.mixins.messages.MessagesMixin`.
+        """
+        request = self.request
+        if request.method not in ('GET', 'HEAD') or '_gaetk' in request.query_string:
+            return None
+        uid = ''
+        if self.credential is not None:
+            if not self.response_cache_per_credential:
+                return None
+            uid = self.credential.uid
+        parts = [get_release(), request.path, request.query_string, uid]
+        parts.extend(request.headers.get(header, '') for header in self.response_cache_vary)
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    @classmethod
+    def invalidate_response_cache(cls):
+        """Drop all responses of this handler class cached on all instances.
+
+        Call this after changing data displayed by the handler.
+        """
+        _response_cache.invalidate(cls._response_cache_generation_key())
+
+    @classmethod
+    def _response_cache_generation_key(cls):
+        return 'generation:{}.{}'.format(cls.__module__, cls.__name__)
+
+    def _serve_from_response_cache(self):
+        """Fill `self.response` from the response cache. Returns `True` if successful."""
+        key = self.get_response_cache_key()
+        if key is None:
+            return False
+        cached, generation = _response_cache.lookup(key, self._response_cache_generation_key())
+        if cached is None:
+            # remember for `_store_in_response_cache()`
+            self._gaetk_response_cache = (key, generation)
+            return False
+        status, headers, body = cached
+        self.response.status = status
+        for name, value in headers:
+            self.response.headers[name] = value
+        self.response.headers[b'X-Gaetk2-Response-Cache'] = b'hit'
+        self.response.body = body
+        return True
+
+    def _store_in_response_cache(self, response):
+        """Put successful responses to `GET` into the response cache."""
+        key, generation = self._gaetk_response_cache
+        self._gaetk_response_cache = None
+        if self.request.method != 'GET' or response.status_int != 200:
+            return
+        if not isinstance(response.app_iter, (list, tuple)):
+            # streaming response
+            return
+        if 'Set-Cookie' in response.headers:
+            return
+        headers = [
+            (name, value)
+            for (name, value) in response.headers.items()
+            if name.lower() not in ('content-length', 'server-timing')
+        ]
+        _response_cache.set(
+            key,
+            (response.status, headers, response.body),
+            generation=generation,
+            ttl=self.response_cache_ttl,
+        )
+
+    def _finish_timing(self, response):
+        """Aggregate phase timings and send them to staff as ``Server-Timing`` header."""
+        timer = self._gaetk_timer
+        self._stop_timing()
+        metrics.record(self._get_metrics_route(), timer)
+        if response is not None and self.is_staff():
+            response.headers[b'Server-Timing'] = timer.header().encode('ascii')
+
+    def _stop_timing(self):
+        """Stop counting RPCs and stop the profiler. Can be called more than once."""
+        self._gaetk_timer.deactivate()
+        if self._gaetk_profile:
+            profile, self._gaetk_profile = self._gaetk_profile, None
+            profile.stop()
+
+    def _get_metrics_route(self):
+        """Name under which statistics and profiles for this request are aggregated."""
+        route = getattr(self.request.route, 'template', None) or self.__class__.__name__
+        return '{} {}'.format(self.request.method, route)
+
+    def _log_trace(self, method_name):
+        """Log the hook timings recorded during dispatch.
+
+        Tracing is enabled if the logger of this module is at `DEBUG` level
+        or for sysadmins adding ``_gaetk_trace=1`` to the URL. We only know if
+        the user is a sysadmin after authentication, so timings are recorded
+        for everybody asking and only logged for sysadmins.
+        """
+        trace, self._gaetk_trace = self._gaetk_trace, None
+        if not trace:
+            return
+        if not (LOGGER.isEnabledFor(logging.DEBUG) or self.is_sysadmin()):
+            return
+        LOGGER.info(
+            'hook timings for %s.%s: %.1f ms total\n%s',
+            self.__class__.__name__,
+            method_name,
+            sum(duration for (_, _, duration) in trace) * 1000,
+            '\n'.join(
+                '{:8.1f} ms {} {}'.format(duration * 1000, funcname, clsname)
+                for (funcname, clsname, duration) in trace
+            ),
+        )
 
     def handle_exception(self, exception, debug):
         """Called if this handler throws an exception during execution.
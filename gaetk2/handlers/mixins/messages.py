@@ -11,11 +11,17 @@ import time
 
 import jinja2
 
+from gaetk2.tools.lazy import LazyValue
+
 
 class MessagesMixin(object):
     """MessagesMixin provides the possibility to send messages to the user.
 
     Like Push-Notifications without the pushing.
+
+    Messages are stored in the session under `_gaetk_messages`, which is a
+    volatile key: it is never written to the datastore (see
+    `gaetk2._gaesessions.VOLATILE_KEYS`).
     """
 
     def add_message(self, typ, text, ttl=15):
@@ -35,12 +41,20 @@ class MessagesMixin(object):
         self.session['_gaetk_messages'] = messages
 
     def build_context(self, uservalues):
-        u"""Add Messages to context."""
-        myvalues = dict(_gaetk_messages=self.session.get('_gaetk_messages', []))
+        u"""Add Messages to context.
+
+        The session is only accessed if the template uses `_gaetk_messages`.
+        """
+        myvalues = dict(_gaetk_messages=LazyValue(self._get_messages_for_display))
         myvalues.update(uservalues)
-        self._expire_messages()
         return myvalues
 
+    def _get_messages_for_display(self):
+        """Return current messages and remove expired ones from the session."""
+        messages = self.session.get('_gaetk_messages', [])
+        self._expire_messages()
+        return messages
+
     def _expire_messages(self):
         """Remove Messages already displayed."""
         new = []
@@ -226,8 +226,7 @@ class PaginateMixin(object):
     def get_paginator_template(self, values):
         env = self.get_jinja2env()
         template = env.get_template('gaetk_fragments/PaginateMixin.paginator.html')
-        values = self._reduce_all_inherited('build_context', values)
-        return template.render(values)
+        return template.render(self.build_fragment_context(values))
 
 
 def _xdb_fetch_page(query, limit, offset=None, start_cursor=None):
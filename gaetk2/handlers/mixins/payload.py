@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gaetk2/handlers/mixins/payload.py - read taskqueue payloads.
+
+Created by Maximillian Dornseif on 2019-03-14.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from gaetk2.taskqueue import decode_payload
+from gaetk2.taskqueue import iter_payload_records
+
+
+class TaskPayloadMixin(object):
+    """Read payloads sent by :func:`gaetk2.taskqueue.taskqueue_add_multi_payload`.
+
+    Compressed and uncompressed payloads are detected transparently.
+
+    Example::
+
+        class ImportHandler(DefaultHandler, TaskPayloadMixin):
+            def post(self):
+                for record in self.iter_payload_records():
+                    import_record(record)
+
+    :meth:`get_payload` returns the whole payload at once - a list of
+    records if the task was generated using `records_per_task`.
+    :meth:`iter_payload_records` decodes the payload incrementally
+    which keeps memory usage low for big batches.
+    """
+
+    def get_payload(self):
+        """Return the decoded request body."""
+        if not hasattr(self, '_gaetk_payload'):
+            self._gaetk_payload = decode_payload(self.request.body)
+        return self._gaetk_payload
+
+    def iter_payload_records(self):
+        """Yield the records contained in the request body one by one."""
+        return iter_payload_records(self.request.body)
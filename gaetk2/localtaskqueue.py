@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""gaetk2.localtaskqueue - in-process stand-in for App Engine taskqueues.
+
+In ``GAETK2_UNITTEST`` mode :func:`gaetk2.taskqueue.defer` normally executes
+the callable synchronously. This hides ordering bugs and makes fan-out code
+unrealistically slow to test. If you install a :class:`LocalTaskQueue`
+deferred tasks are instead executed by a thread pool with most of the
+semantics of the real thing:
+
+* named queues, optionally with limited concurrency per queue
+* `countdown` / `eta` scheduling
+* retries with exponential backoff, ``PermanentTaskFailure`` stops retrying
+* task names and tombstones
+* :meth:`LocalTaskQueue.drain` to wait until all work is done
+
+Usage in your test setup::
+
+    os.environ['GAETK2_UNITTEST'] = '1'
+    executor = gaetk2.localtaskqueue.install(workers=8, queues={'softmq': 1})
+    defer(fan_out, 1000)
+    stats = executor.drain(timeout=30)
+    print(stats['tasks_per_second'])
+    gaetk2.localtaskqueue.uninstall()
+
+This module does not need the App Engine SDK.
+
+Created by Maximillian Dornseif on 2019-03-12.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import calendar
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+_executor = None
+_current = threading.local()  # the task executed by a worker thread
+
+
+class Error(Exception):
+    """Base class for errors in this module."""
+
+
+class TaskAlreadyExistsError(Error):
+    """A task with this name is already pending."""
+
+
+class TombstonedTaskError(Error):
+    """A task with this name did already run."""
+
+
+class DrainTimeout(Error):
+    """Raised if :meth:`LocalTaskQueue.drain` does not finish in time."""
+
+
+class LocalTask(object):
+    """A single unit of work.
+
+    `retry_count` is the number of previous attempts - like the
+    ``X-AppEngine-TaskRetryCount`` header. After `max_retries` retries
+    the task is not executed again.
+    """
+
+    def __init__(self, name, queue, func, args, kwargs, eta, max_retries=None):
+        self.name = name
+        self.queue = queue
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.eta = eta
+        self.retry_count = 0
+        self.max_retries = max_retries
+        self.exc_info = None
+
+    def __repr__(self):
+        return '<LocalTask {} on {}: {}>'.format(
+            self.name, self.queue, getattr(self.func, '__name__', self.func))
+
+
+class LocalTaskQueue(object):
+    """Thread pool executing deferred work like the App Engine taskqueue would.
+
+    Parameters:
+        workers (int): number of threads executing tasks.
+        queues (dict): maximum number of concurrently running tasks per queue name.
+            Queues not listed are unlimited (besides `workers`).
+        max_retries (int): how often a failing task is retried before we give up.
+        retry_delay (float): delay before the first retry. Doubles with each retry.
+        max_backoff (float): upper limit for the retry delay.
+        realtime (bool): if `False` countdowns and ETAs only determine the
+            execution order but nobody waits for them. Handy for fast tests.
+
+    """
+
+    def __init__(self, workers=4, queues=None, max_retries=5, retry_delay=0.1,
+                 max_backoff=5.0, realtime=True):
+        self.queue_limits = dict(queues or {})
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.realtime = realtime
+        self.failures = []
+        self._reported_failures = 0  # failures already raised by drain()
+        self._heap = []
+        self._seq = itertools.count()
+        self._pending = {}  # name -> task
+        self._tombstones = set()
+        self._running = {}  # queue -> count
+        self._stats = {}
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._started = time.time()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='LocalTaskQueue-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def add(self, func, args=(), kwargs=None, name=None, queue='default', countdown=None, eta=None):
+        """Enqueue `func(*args, **kwargs)`.
+
+        Raises:
+            TaskAlreadyExistsError: if a task named `name` is pending.
+            TombstonedTaskError: if a task named `name` did already run.
+
+        Returns:
+            :class:`LocalTask`
+
+        """
+        now = time.time()
+        if eta is not None:
+            if hasattr(eta, 'utctimetuple'):
+                # like the SDK we assume naive datetimes to be UTC
+                eta = calendar.timegm(eta.utctimetuple()) + eta.microsecond / 1000000.0
+        else:
+            eta = now + (countdown or 0)
+        with self._cond:
+            if name is None:
+                name = 'task{}'.format(next(self._seq))
+            elif name in self._pending:
+                raise TaskAlreadyExistsError(name)
+            elif name in self._tombstones:
+                raise TombstonedTaskError(name)
+            task = LocalTask(
+                name, queue or 'default', func, tuple(args), dict(kwargs or {}), eta, self.max_retries)
+            self._pending[name] = task
+            self._count(task.queue, 'enqueued')
+            self._push(task)
+            self._cond.notify_all()
+        return task
+
+    def drain(self, timeout=None, raise_errors=True):
+        """Block until no tasks are pending or running.
+
+        Parameters:
+            timeout (float or None): maximum seconds to wait.
+            raise_errors (bool): re-raise the exception of the first
+                task which failed permanently since the previous drain.
+
+        Returns:
+            A dict of statistics - see :meth:`stats`.
+
+        Raises:
+            DrainTimeout: if `timeout` was exceeded.
+
+        """
+        start = time.time()
+        with self._cond:
+            while self._pending:
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise DrainTimeout('{} tasks still pending'.format(len(self._pending)))
+                self._cond.wait(remaining)
+        ret = self.stats()
+        ret['drain_seconds'] = time.time() - start
+        with self._cond:
+            new_failures = self.failures[self._reported_failures:]
+            self._reported_failures = len(self.failures)
+        if raise_errors and new_failures:
+            task = new_failures[0]
+            raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+        return ret
+
+    def stats(self):
+        """Return counters per queue and overall throughput."""
+        with self._cond:
+            queues = {name: dict(counters) for (name, counters) in self._stats.items()}
+            executed = sum(counters.get('executed', 0) for counters in queues.values())
+            elapsed = time.time() - self._started
+            return dict(
+                queues=queues,
+                pending=len(self._pending),
+                executed=executed,
+                failed=len(self.failures),
+                elapsed=elapsed,
+                tasks_per_second=executed / elapsed if elapsed else 0.0,
+            )
+
+    def shutdown(self):
+        """Stop all worker threads. Pending tasks are discarded."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(1)
+
+    # internal stuff
+
+    def _push(self, task):
+        heapq.heappush(self._heap, (task.eta, next(self._seq), task))
+
+    def _count(self, queue, counter):
+        counters = self._stats.setdefault(queue, {})
+        counters[counter] = counters.get(counter, 0) + 1
+
+    def _next_task(self):
+        """Return the next runnable task. Must be called holding the lock."""
+        while not self._shutdown:
+            now = time.time()
+            deferred = []
+            task = None
+            while self._heap:
+                eta, _, candidate = self._heap[0]
+                if self.realtime and eta > now:
+                    break
+                heapq.heappop(self._heap)
+                limit = self.queue_limits.get(candidate.queue)
+                if limit is not None and self._running.get(candidate.queue, 0) >= limit:
+                    deferred.append(candidate)
+                    continue
+                task = candidate
+                break
+            for candidate in deferred:
+                self._push(candidate)
+            if task:
+                self._running[task.queue] = self._running.get(task.queue, 0) + 1
+                return task
+            if self._heap and self.realtime and not deferred:
+                self._cond.wait(max(0.001, self._heap[0][0] - now))
+            else:
+                self._cond.wait(0.1 if self._heap else None)
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+            if task is None:
+                return
+            _current.task = task
+            try:
+                task.func(*task.args, **task.kwargs)
+            except BaseException:
+                exc_info = sys.exc_info()
+            else:
+                exc_info = None
+            finally:
+                _current.task = None
+            with self._cond:
+                self._running[task.queue] -= 1
+                if exc_info is None:
+                    self._finish(task, 'executed')
+                elif ('PermanentTaskFailure' in repr(exc_info[0])
+                      or task.retry_count >= self.max_retries):
+                    LOGGER.error('task %r failed permanently', task, exc_info=exc_info)
+                    task.exc_info = exc_info
+                    self.failures.append(task)
+                    self._finish(task, 'failed')
+                else:
+                    LOGGER.info('task %r failed, retrying', task, exc_info=exc_info)
+                    delay = min(self.retry_delay * (2 ** task.retry_count), self.max_backoff)
+                    task.retry_count += 1
+                    task.eta = time.time() + delay
+                    self._count(task.queue, 'retried')
+                    self._push(task)
+                self._cond.notify_all()
+
+    def _finish(self, task, counter):
+        del self._pending[task.name]
+        self._tombstones.add(task.name)
+        self._count(task.queue, counter)
+
+
+def install(**kwargs):
+    """Create a :class:`LocalTaskQueue` to be used by :func:`gaetk2.taskqueue.defer`.
+
+    Only used in ``GAETK2_UNITTEST`` mode. Arguments are passed to
+    :class:`LocalTaskQueue`.
+    """
+    global _executor
+    uninstall()
+    _executor = LocalTaskQueue(**kwargs)
+    return _executor
+
+
+def uninstall():
+    """Shut down the installed :class:`LocalTaskQueue` (if any)."""
+    global _executor
+    if _executor:
+        _executor.shutdown()
+    _executor = None
+
+
+def get_executor():
+    """Return the installed :class:`LocalTaskQueue` or `None`."""
+    return _executor
+
+
+def get_current_task():
+    """Return the :class:`LocalTask` executed by the current thread or `None`."""
+    return getattr(_current, 'task', None)
@@ -68,3 +68,15 @@ class gaetk_Credential(ndb.Model):
             cred2.name = cred1.name
         cred2.put()
         return cred2
+
+
+class gaetk_TaskResult(ndb.Model):
+    """Return value or exception of a task started by :func:`gaetk2.taskqueue.defer_with_result`.
+
+    The key is the task name.
+    """
+    _use_cache = False
+    _use_memcache = False  # we do our own caching
+    data = ndb.BlobProperty()  # zlib compressed pickle of `(success, value)`
+    expires_at = ndb.DateTimeProperty(indexed=True)
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
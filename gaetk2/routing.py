@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""gaetk2.routing - faster route matching for big applications.
+
+:class:`webapp2.Router` tries all routes one after another until one of
+them matches. With hundreds of routes most requests spend a noticeable
+amount of time in failing regular expressions. :class:`IndexedRouter`
+builds a character trie of the static prefix of each route (everything in
+the template before the first ``<``). For a given path only routes whose
+prefix matches are tried. Routes without a known prefix (e.g. custom
+:class:`webapp2.BaseRoute` subclasses) are always tried. Candidates are
+tried in the order the routes were added, so matching semantics are
+exactly those of :class:`webapp2.Router`.
+
+:class:`gaetk2.application.WSGIApplication` uses this router by default.
+
+This module does not need the App Engine SDK.
+
+Created by Maximillian Dornseif on 2019-03-25.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import threading
+import urllib
+
+import webapp2
+
+from gaetk2 import exc
+
+
+# characters which end the literal prefix of a regular expression
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+
+def _method_unchanged(route, cls, name):
+    """Check that `route` uses the implementation of `name` from `cls`."""
+    return getattr(type(route), name).__func__ is getattr(cls, name).__func__
+
+
+def get_static_prefix(route):
+    """Return the literal text every path matched by `route` starts with.
+
+    Returns `None` if we don't know how `route` matches.
+    """
+    if isinstance(route, webapp2.Route) and _method_unchanged(route, webapp2.Route, 'match'):
+        return route.template.split('<', 1)[0]
+    if isinstance(route, webapp2.SimpleRoute) and _method_unchanged(route, webapp2.SimpleRoute, 'match'):
+        template = route.template
+        if '|' in template:
+            return ''
+        if template.startswith('^'):
+            template = template[1:]
+        prefix = []
+        for char in template:
+            if char in _REGEX_SPECIAL:
+                if char in '*?{' and prefix:
+                    # the last character is optional
+                    prefix.pop()
+                break
+            prefix.append(char)
+        return ''.join(prefix)
+    return None
+
+
+class IndexedRouter(webapp2.Router):
+    """:class:`webapp2.Router` which only tries routes which can possibly match.
+
+    Parameters:
+        routes: like :class:`webapp2.Router`.
+        cache_size (int): number of paths for which the candidate routes are kept.
+
+    """
+
+    def __init__(self, routes=None, cache_size=2000):
+        self.cache_size = cache_size
+        self._index = None
+        self._cache = collections.OrderedDict()  # path -> candidate routes
+        self._lock = threading.Lock()
+        super(IndexedRouter, self).__init__(routes)
+
+    def add(self, route):
+        """Add a route. The index is rebuilt on the next request."""
+        super(IndexedRouter, self).add(route)
+        with self._lock:
+            self._index = None
+            self._cache.clear()
+
+    def _build_index(self):
+        """Return a trie of ``[route positions, {character: node}]``."""
+        root = [[], {}]
+        for pos, route in enumerate(self.match_routes):
+            prefix = get_static_prefix(route)
+            node = root
+            for char in (prefix or ''):
+                node = node[1].setdefault(char, [[], {}])
+            node[0].append(pos)
+        return root
+
+    def get_candidates(self, path):
+        """Return the routes which might match `path` in the order they were added."""
+        with self._lock:
+            candidates = self._cache.pop(path, None)
+            if candidates is not None:
+                self._cache[path] = candidates
+                return candidates
+            if self._index is None:
+                self._index = self._build_index()
+            node = self._index
+            positions = list(node[0])
+            for char in path:
+                node = node[1].get(char)
+                if node is None:
+                    break
+                positions.extend(node[0])
+            candidates = tuple(self.match_routes[pos] for pos in sorted(positions))
+            self._cache[path] = candidates
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return candidates
+
+    def default_matcher(self, request):
+        """Like :meth:`webapp2.Router.default_matcher` but only tries candidates."""
+        method_not_allowed = False
+        for route in self.get_candidates(urllib.unquote(request.path)):
+            try:
+                match = route.match(request)
+                if match:
+                    return match
+            except exc.HTTP405_HTTPMethodNotAllowed:
+                method_not_allowed = True
+
+        if method_not_allowed:
+            raise exc.HTTP405_HTTPMethodNotAllowed()
+
+        raise exc.HTTP404_NotFound()
+
+    match = default_matcher
+
+    def describe_miss(self, request):
+        """Short description of why `request` did not match - for logging 404s."""
+        candidates = self.get_candidates(urllib.unquote(request.path))
+        return '{} {}: {} routes, tried {}'.format(
+            request.method,
+            request.path,
+            len(self.match_routes),
+            ', '.join(getattr(route, 'template', repr(route)) for route in candidates) or 'none',
+        )
@@ -9,19 +9,32 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import datetime
+import functools
 import hashlib
 import logging
+import math
 import os
+import pickle
+import Queue
 import re
+import threading
+import time
 import zlib
 
 import google.appengine.ext.deferred.deferred
 
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
 
+from gaetk2 import localtaskqueue
+from gaetk2.models import gaetk_TaskResult
 from gaetk2.tools import hujson2
 from gaetk2.tools.datetools import date_trunc
+from gaetk2.tools.ids import guid128
 from gaetk2.tools.unicode import slugify
 
 
@@ -49,24 +62,275 @@ def taskqueue_add_multi(qname, url, paramlist, **kwargs):
         taskqueue.Queue(name=qname).add(tasks)
 
 
-def taskqueue_add_multi_payload(name, url, payloadlist, **kwargs):
+def taskqueue_add_multi_payload(name, url, payloadlist, records_per_task=None, **kwargs):
     """like taskqueue_add_multi() but transmit a json encoded payload instead a query parameter.
 
-    In the Task handler you can get the data via ``zdata = json.loads(self.request.body)``.
-    See http://code.google.com/appengine/docs/python/taskqueue/tasks.html
+    The payload is zlib compressed. In the Task handler you can get the data via
+    :meth:`gaetk2.handlers.mixins.payload.TaskPayloadMixin.get_payload` or
+    :func:`decode_payload`. See
+    http://code.google.com/appengine/docs/python/taskqueue/tasks.html
+
+    If `records_per_task` is given, up to that many entries of `payloadlist`
+    are packed into a single task as a `JSON text sequence
+    <https://tools.ietf.org/html/rfc7464>`_ (one record per line). Use
+    :func:`iter_payload_records` to process them one at a time.
+
+    For pull queues use ``url=None`` and ``method='PULL'``. You might want to
+    give a ``tag`` to allow grouped processing. See :class:`PullQueueConsumer`.
     """
+    if url:
+        kwargs['url'] = url
+    if records_per_task:
+        chunks = [
+            payloadlist[i:i + records_per_task]
+            for i in range(0, len(payloadlist), records_per_task)
+        ]
+        payloads = [encode_payload_records(chunk) for chunk in chunks]
+        if kwargs.get('method', 'POST') != 'PULL':
+            # don't modify the headers dict of the caller
+            kwargs['headers'] = dict(kwargs.get('headers') or {})
+            kwargs['headers']['Content-Type'] = 'application/json-seq'
+    else:
+        payloads = (zlib.compress(hujson2.dumps(payload)) for payload in payloadlist)
     tasks = []
-    for payload in payloadlist:
-        payload = hujson2.dumps(payload)
-        payload = zlib.compress(payload)
-        tasks.append(taskqueue.Task(url=url, payload=payload, **kwargs))
+    count = 0
+    for payload in payloads:
+        tasks.append(taskqueue.Task(payload=payload, **kwargs))
+        count += 1
         # Patch Addition to Taskqueue
         if len(tasks) >= 50:
             taskqueue.Queue(name=name).add(tasks)
             tasks = []
     if tasks:
         taskqueue.Queue(name=name).add(tasks)
-    LOGGER.debug('%d tasks queued to %s', len(payloadlist), url)
+    LOGGER.debug('%d records in %d tasks queued to %s', len(payloadlist), count, url)
+
+
+# JSON text sequences (RFC 7464): every record is prefixed by RS and terminated by LF
+_RECORD_SEPARATOR = b'\x1e'
+
+
+def encode_payload_records(records):
+    """Encode and compress a list of records as JSON text sequence."""
+    return zlib.compress(b''.join(
+        _RECORD_SEPARATOR + hujson2.dumps(record, indent=None).encode('utf-8') + b'\n'
+        for record in records
+    ))
+
+
+def _decompress_chunks(payload, chunk_size):
+    """Yield decompressed chunks of `payload`. Uncompressed data is passed through."""
+    # zlib streams start with a two byte header which is a multiple of 31
+    if len(payload) < 2 or ord(payload[0]) & 0x0f != 8 or (ord(payload[0]) * 256 + ord(payload[1])) % 31:
+        yield payload
+        return
+    decompressor = zlib.decompressobj()
+    for i in range(0, len(payload), chunk_size):
+        data = decompressor.decompress(payload[i:i + chunk_size])
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def iter_payload_records(payload, chunk_size=64 * 1024):
+    """Decode a payload generated by :func:`taskqueue_add_multi_payload` record by record.
+
+    For payloads generated with `records_per_task` the payload is decompressed
+    and decoded incrementally, so only a single record has to be kept in memory.
+    Single record payloads (and uncompressed JSON) yield exactly one record.
+    """
+    chunks = _decompress_chunks(payload, chunk_size)
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        if buf:
+            break
+    if not buf.startswith(_RECORD_SEPARATOR):
+        # plain JSON document
+        yield hujson2.loads(buf + b''.join(chunks))
+        return
+
+    while True:
+        lines = buf.split(b'\n')
+        buf = lines.pop()  # incomplete line
+        for line in lines:
+            line = line.lstrip(_RECORD_SEPARATOR)
+            if line.strip():
+                yield hujson2.loads(line)
+        try:
+            buf += next(chunks)
+        except StopIteration:
+            break
+    buf = buf.lstrip(_RECORD_SEPARATOR)
+    if buf.strip():
+        # truncated record - RFC 7464 says we should ignore it, we prefer to know
+        yield hujson2.loads(buf)
+
+
+def decode_payload(payload):
+    """Decode a payload generated by :func:`taskqueue_add_multi_payload`.
+
+    Uncompressed JSON is also accepted. JSON text sequences (generated with
+    `records_per_task`) are returned as a list of records.
+    """
+    data = b''.join(_decompress_chunks(payload, len(payload) or 1))
+    if data.startswith(_RECORD_SEPARATOR):
+        return list(iter_payload_records(data))
+    return hujson2.loads(data)
+
+
+class PullQueueConsumer(object):
+    """Lease tasks from a pull queue in batches and process them in parallel.
+
+    Tasks are expected to be generated by :func:`taskqueue_add_multi_payload`
+    with ``method='PULL'``. Each payload is decoded and handed to `func`.
+    If tasks contain multiple records (see `records_per_task`) `func` is called
+    for each record. Tasks where `func` returned without an exception for all
+    records are deleted in bulk.
+    Failing tasks are left alone, so they are leased again after their lease
+    expires (and ``retry_count`` is incremented by App Engine).
+    Leases of tasks which take long to process are extended automatically.
+
+    Parameters:
+        qname (str): name of the pull queue.
+        func: called with each decoded record.
+        lease_seconds (int): duration of the lease.
+        batch_size (int): how many tasks to lease at once (max. 1000).
+        workers (int): how many tasks are processed in parallel.
+        tag (str or None): only lease tasks with this tag.
+        group_by_tag (bool): lease only tasks with the same tag as the
+            oldest task in the queue. Ignored if `tag` is given.
+
+    Example::
+
+        def process_event(event):
+            ...
+
+        class EventWorker(DefaultHandler):
+            def get(self):
+                consumer = PullQueueConsumer('eventsq', process_event, group_by_tag=True)
+                self.return_text('%d tasks' % consumer.run(deadline=8 * 60))
+
+    """
+
+    def __init__(self, qname, func, lease_seconds=60, batch_size=100, workers=8,
+                 tag=None, group_by_tag=False):
+        self.qname = qname
+        self.func = func
+        self.lease_seconds = lease_seconds
+        self.batch_size = min(batch_size, 1000)  # API limit
+        self.workers = workers
+        self.tag = tag
+        self.group_by_tag = group_by_tag
+        self.queue = taskqueue.Queue(name=qname)
+
+    def lease(self):
+        """Lease a batch of tasks."""
+        if self.tag or self.group_by_tag:
+            return self.queue.lease_tasks_by_tag(self.lease_seconds, self.batch_size, tag=self.tag)
+        return self.queue.lease_tasks(self.lease_seconds, self.batch_size)
+
+    def process_batch(self):
+        """Lease and process a single batch.
+
+        Returns:
+            (leased, succeeded) - the number of tasks leased and processed successfully.
+
+        """
+        leased_at = time.time()
+        tasks = self.lease()
+        if not tasks:
+            return 0, 0
+        succeeded = self._process(tasks, leased_at)
+        # `delete_tasks` is limited to 1000 tasks per call
+        for i in range(0, len(succeeded), 1000):
+            self.queue.delete_tasks(succeeded[i:i + 1000])
+        LOGGER.debug(
+            '%s: %d tasks leased, %d succeeded', self.qname, len(tasks), len(succeeded))
+        return len(tasks), len(succeeded)
+
+    def run(self, deadline=None, max_batches=None):
+        """Process batches until the queue is empty.
+
+        Parameters:
+            deadline (float or None): stop leasing new batches after this many seconds.
+            max_batches (int or None): stop after this many batches.
+
+        Returns:
+            the number of tasks processed successfully.
+
+        """
+        start = time.time()
+        total = batches = 0
+        while max_batches is None or batches < max_batches:
+            if deadline and time.time() - start > deadline:
+                break
+            leased, succeeded = self.process_batch()
+            if not leased:
+                break
+            batches += 1
+            total += succeeded
+        return total
+
+    def _process(self, tasks, leased_at=None):
+        """Process tasks in parallel, extending leases. Returns tasks which succeeded.
+
+        Leases of all unfinished tasks are extended - also of tasks still
+        waiting for a worker.
+        """
+        if leased_at is None:
+            leased_at = time.time()
+        todo = Queue.Queue()
+        # task name -> (task, time when the lease expires)
+        unfinished = {}
+        for task in tasks:
+            todo.put(task)
+            unfinished[task.name] = (task, leased_at + self.lease_seconds)
+        succeeded = []
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                try:
+                    task = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    for record in iter_payload_records(task.payload):
+                        self.func(record)
+                except Exception:
+                    LOGGER.exception('%s: processing %s failed', self.qname, task.name)
+                else:
+                    with lock:
+                        succeeded.append(task)
+                finally:
+                    with lock:
+                        del unfinished[task.name]
+
+        threads = [threading.Thread(target=work) for _ in range(min(self.workers, len(tasks)))]
+        for thread in threads:
+            thread.start()
+        while True:
+            alive = [thread for thread in threads if thread.is_alive()]
+            if not alive:
+                break
+            alive[0].join(self.lease_seconds / 4.0)
+            threshold = time.time() + self.lease_seconds / 2.0
+            with lock:
+                expiring = [task for (task, expires) in unfinished.values() if expires < threshold]
+            for task in expiring:
+                extended_at = time.time()
+                try:
+                    self.queue.modify_task_lease(task, self.lease_seconds)
+                except taskqueue.Error:
+                    LOGGER.warn('%s: could not extend lease of %s', self.qname, task.name)
+                    continue
+                with lock:
+                    if task.name in unfinished:
+                        unfinished[task.name] = (task, extended_at + self.lease_seconds)
+        return succeeded
 
 
 # See also https://github.com/freshplanet/AppEngine-Deferred
@@ -90,7 +354,49 @@ def defer(obj, *args, **kwargs):
     Parameters starting with ``_`` are handed down to
     `taskqueue.add() <https://cloud.google.com/appengine/docs/standard/python/refdocs/
     google.appengine.api.taskqueue.taskqueue#google.appengine.api.taskqueue.taskqueue.add>`_
+
+    In ``GAETK2_UNITTEST`` mode the callable is executed immediately - unless
+    a :class:`gaetk2.localtaskqueue.LocalTaskQueue` was installed via
+    :func:`gaetk2.localtaskqueue.install`.
     """
+    if '_url' not in kwargs:
+        kwargs['_url'] = _deferred_url(obj, args, kwargs)
+    # kwargs["_queue"] = kwargs.pop("_queue", 'workersq')
+    if os.environ.get('GAETK2_UNITTEST'):
+        executor = localtaskqueue.get_executor()
+        if not executor:
+            LOGGER.debug('UNITTEST-mode - starting now')
+            obj(*args, **{k: v for k, v in kwargs.items() if not k.startswith('_')})
+            return None
+        try:
+            task = executor.add(
+                obj,
+                args,
+                {k: v for k, v in kwargs.items() if not k.startswith('_')},
+                name=kwargs.get('_name'),
+                queue=kwargs.get('_queue'),
+                countdown=kwargs.get('_countdown'),
+                eta=kwargs.get('_eta'),
+            )
+            LOGGER.debug('UNITTEST-mode - queued %r', task.name)
+            return task.name
+        except localtaskqueue.TaskAlreadyExistsError:
+            LOGGER.info('Task already exists')
+        except localtaskqueue.TombstonedTaskError:
+            LOGGER.info('Task did already run')
+    else:
+        try:
+            task = deferred.defer(obj, *args, **kwargs)
+            LOGGER.debug('started task %r', task.name)
+            return task.name
+        except taskqueue.TaskAlreadyExistsError:
+            LOGGER.info('Task already exists')
+        except taskqueue.TombstonedTaskError:
+            LOGGER.info('Task did already run')
+
+
+def _deferred_url(obj, args, kwargs):
+    """Generate an URL containing function name and parameters for easier debugging."""
     try:
         suffix = '{}({!s},{!r})'.format(
             getattr(obj, '__name__', '.?.'),
@@ -105,21 +411,7 @@ def defer(obj, *args, **kwargs):
         suffix = ''
     suffix = re.sub(r'-+', '-', suffix.replace(' ', '-'))
     suffix = re.sub(r'[^/A-Za-z0-9_.:;@&=$_+!*,\'\(\)\-]+', '', suffix)
-    url = google.appengine.ext.deferred.deferred._DEFAULT_URL + '/' + suffix[:200]
-    kwargs['_url'] = kwargs.pop('_url', url)
-    # kwargs["_queue"] = kwargs.pop("_queue", 'workersq')
-    if os.environ.get('GAETK2_UNITTEST'):
-        LOGGER.debug('UNITTEST-mode - starting now')
-        obj(*args, **{k: v for k, v in kwargs.items() if not k.startswith('_')})
-    else:
-        try:
-            task = deferred.defer(obj, *args, **kwargs)
-            LOGGER.debug('started task %r', task.name)
-            return task.name
-        except taskqueue.TaskAlreadyExistsError:
-            LOGGER.info('Task already exists')
-        except taskqueue.TombstonedTaskError:
-            LOGGER.info('Task did already run')
+    return google.appengine.ext.deferred.deferred._DEFAULT_URL + '/' + suffix[:200]
 
 
 def _to_str(value):
@@ -180,3 +472,210 @@ def _defer_once_per_x(trunc, obj, *args, **kwargs):
     url = google.appengine.ext.deferred.deferred._DEFAULT_URL + '/' + suffix[:200]
     kwargs['_url'] = kwargs.pop('_url', url)
     return defer(obj, _name=slugify(name), *args, **kwargs)
+
+
+def defer_ratelimited(bucket, obj, *args, **kwargs):
+    """Like :func:`defer()` but spread execution to match the rate of `bucket`.
+
+    `bucket` is a :class:`gaetk2.tools.ratelimit.TokenBucket` describing how
+    much load a downstream system (e.g. the ERP) can handle. For each task
+    a token is reserved and the task is scheduled via `_countdown` at the
+    point in time when the token becomes available. So if you enqueue 1000
+    tasks against a bucket with `rate=5` they will be executed over 200 seconds
+    regardless of how fast the queue could drain.
+
+    Example::
+
+        SOFTM = TokenBucket('softm', rate=5, burst=10)
+        for kundennr in changed:
+            defer_ratelimited(SOFTM, update_kunde, kundennr)
+
+    """
+    wait = bucket.reserve()
+    if wait:
+        kwargs['_countdown'] = int(math.ceil(wait)) + kwargs.pop('_countdown', 0)
+    return defer(obj, *args, **kwargs)
+
+
+def ratelimited(bucket):
+    """Decorator to gate execution of a deferred function with a token bucket.
+
+    If no token is available when the task runs, the task is re-enqueued
+    (on the same queue) with a countdown matching the time when a token
+    has been reserved for it. This protects downstream systems even if
+    tasks are not started via :func:`defer_ratelimited`.
+
+    The decorated function must be defined at module level to be deferable.
+
+    Example::
+
+        @ratelimited(SOFTM)
+        def update_kunde(kundennr):
+            fetch('https://softm.example.com/kunde/{}'.format(kundennr))
+
+        defer(update_kunde, '12345')
+
+    In ``GAETK2_UNITTEST`` mode we sleep instead of re-enqueueing.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if kwargs.pop('_gaetk2_token_reserved', False):
+                # token was reserved when the task was re-enqueued
+                return func(*args, **kwargs)
+            wait = bucket.reserve()
+            if wait >= 1 and not os.environ.get('GAETK2_UNITTEST'):
+                LOGGER.info(
+                    '%s throttled by %r, retrying in %.1f s', func.__name__, bucket, wait)
+                queue = os.environ.get('HTTP_X_APPENGINE_QUEUENAME')
+                if queue:
+                    kwargs['_queue'] = queue
+                defer(
+                    wrapper,
+                    _countdown=int(math.ceil(wait)),
+                    _gaetk2_token_reserved=True,
+                    *args,
+                    **kwargs
+                )
+                return None
+            if wait:
+                time.sleep(wait)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class ResultNotReadyError(Exception):
+    """Raised by :func:`get_result` if the task has not finished (yet)."""
+
+
+def defer_with_result(obj, *args, **kwargs):
+    """Like :func:`defer()` but store the return value for :func:`get_result`.
+
+    This allows async request/response patterns: a request handler starts
+    expensive work (like generating a report) and returns the task name
+    to the client which polls another handler calling :func:`get_result`.
+
+    The return value or the exception raised by `obj` is pickled, compressed
+    and kept for `_result_ttl` seconds (default: one hour) in memcache and
+    the datastore. Exceptions are retried `_result_retries` times (default: 2)
+    by the taskqueue before they are stored as the result. Results too big
+    for the datastore are replaced by a `RuntimeError` saying so.
+
+    Returns:
+        the task name to be used with :func:`get_result`.
+
+    Example::
+
+        class ReportStart(JsonHandler):
+            def post(self):
+                return {'name': defer_with_result(generate_report, self.credential.uid)}
+
+        class ReportPoll(JsonHandler):
+            def get(self, name):
+                try:
+                    return {'report': get_result(name, timeout=5)}
+                except ResultNotReadyError:
+                    return {'status': 'pending'}
+
+    """
+    name = kwargs.pop('_name', None) or 'result-{}'.format(guid128().lower())
+    ttl = kwargs.pop('_result_ttl', 60 * 60)
+    retries = kwargs.pop('_result_retries', 2)
+    if '_url' not in kwargs:
+        kwargs['_url'] = _deferred_url(obj, args, kwargs)
+    defer(_call_and_store_result, name, ttl, retries, obj, _name=name, *args, **kwargs)
+    return name
+
+
+def _call_and_store_result(name, ttl, retries, obj, *args, **kwargs):
+    """Executed in the task to run `obj` and store the outcome."""
+    try:
+        result = (True, obj(*args, **kwargs))
+    except Exception as e:
+        if not _is_last_attempt(retries) and 'PermanentTaskFailure' not in repr(e.__class__):
+            raise
+        LOGGER.exception('task %s failed, storing exception', name)
+        result = (False, e)
+    try:
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        LOGGER.exception('can not pickle result of %s', name)
+        data = pickle.dumps((False, RuntimeError(repr(result[1]))), pickle.HIGHEST_PROTOCOL)
+    data = zlib.compress(data)
+    expires_at = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+    try:
+        gaetk_TaskResult(id=name, data=data, expires_at=expires_at).put()
+    except (datastore_errors.BadRequestError, apiproxy_errors.RequestTooLargeError):
+        # the datastore takes entities up to 1 MB
+        LOGGER.exception('result of %s is too big (%d bytes compressed)', name, len(data))
+        data = zlib.compress(pickle.dumps(
+            (False, RuntimeError('result too big to be stored: {} bytes compressed'.format(len(data)))),
+            pickle.HIGHEST_PROTOCOL))
+        gaetk_TaskResult(id=name, data=data, expires_at=expires_at).put()
+    # memcache only takes values up to 1 MB, the datastore is our fallback anyway
+    memcache.set('gaetk2_result:{}'.format(name), data, time=ttl)
+
+
+def _is_last_attempt(retries):
+    """Check if the current task will not be retried (again) if it fails now.
+
+    Stops after `retries` retries - or earlier if the taskqueue gives up first.
+    """
+    if os.environ.get('GAETK2_UNITTEST'):
+        task = localtaskqueue.get_current_task()
+        if task is None:
+            # executed synchronously by `defer()`, nobody will retry
+            return True
+        return task.retry_count >= min(retries, task.max_retries)
+    return int(os.environ.get('HTTP_X_APPENGINE_TASKRETRYCOUNT', 0)) >= retries
+
+
+def get_result(name, timeout=0, poll_interval=0.5):
+    """Get the outcome of a task started via :func:`defer_with_result`.
+
+    Waits up to `timeout` seconds for the task to finish. Memcache is checked
+    first, then the datastore.
+
+    Returns:
+        whatever the deferred callable returned.
+
+    Raises:
+        ResultNotReadyError: if there is no result after `timeout` seconds.
+        Exception: if the deferred callable raised an exception, this is re-raised.
+
+    """
+    start = time.time()
+    key = 'gaetk2_result:{}'.format(name)
+    while True:
+        data = memcache.get(key)
+        if data is None:
+            entity = gaetk_TaskResult.get_by_id(name)
+            if entity and entity.expires_at > datetime.datetime.now():
+                data = entity.data
+                memcache.set(
+                    key, data,
+                    time=max(1, int((entity.expires_at - datetime.datetime.now()).total_seconds())))
+        if data is not None:
+            success, value = pickle.loads(zlib.decompress(data))
+            if not success:
+                raise value
+            return value
+        if time.time() - start + poll_interval > timeout:
+            raise ResultNotReadyError(name)
+        time.sleep(poll_interval)
+
+
+def delete_expired_results():
+    """Delete expired results from the datastore. To be called via cron.
+
+    Returns `True` if all expired results have been removed.
+    """
+    keys = gaetk_TaskResult.query(
+        gaetk_TaskResult.expires_at < datetime.datetime.now()).fetch(500, keys_only=True)
+    ndb.delete_multi(keys)
+    LOGGER.info('deleted %d expired task results', len(keys))
+    return len(keys) < 500
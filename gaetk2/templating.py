@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""gaetk2.templating - Jinja2 environment setup.
+
+Shared by :meth:`gaetk2.handlers.base.BasicHandler.get_jinja2env` and the
+build step in :file:`bin/build_code.py`, so templates compiled ahead of
+time see exactly the same settings, filters and extensions as templates
+compiled at runtime.
+
+This module does not need the App Engine SDK.
+
+Created by Maximillian Dornseif on 2019-03-19.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import os.path
+import threading
+
+import jinja2
+import jinja2.ext
+
+from gaetk2 import jinja_filters
+from gaetk2.tools import hujson2
+from gaetk2.tools.caching import TwoTierCache
+from jinja2 import nodes
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LayeredBytecodeCache(jinja2.BytecodeCache):
+    """Bytecode cache keeping code objects in instance memory and in memcache.
+
+    Jinja2 only consults the bytecode cache if a template is not in its own
+    template cache. :class:`jinja2.MemcachedBytecodeCache` then needs a
+    memcache round trip and unmarshalling every time. We keep up to
+    `maxsize` compiled code objects in memory (least recently used are
+    dropped) and only ask memcache if that fails.
+
+    Memcache keys contain `release` (usually :func:`gaetk2.config.get_release`)
+    so a deployment never sees bytecode of the previous one. Memcache errors
+    are logged and ignored - we just compile the template again.
+
+    Parameters:
+        client: something like :mod:`google.appengine.api.memcache`.
+            `None` disables the second tier.
+        release (str): part of the memcache key.
+        maxsize (int): number of templates kept in memory.
+        timeout (int): memcache expiry in seconds.
+
+    """
+
+    def __init__(self, client=None, release='', maxsize=200, timeout=3600):
+        self.client = client
+        self.prefix = 'gaetk2_jinja2_bytecode:{}:'.format(release)
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+        self._lru = collections.OrderedDict()  # bucket.key -> (checksum, code)
+        self._lock = threading.Lock()
+
+    def load_bytecode(self, bucket):
+        """Fill `bucket.code` from instance memory or memcache (if possible)."""
+        with self._lock:
+            entry = self._lru.pop(bucket.key, None)
+            if entry is not None and entry[0] == bucket.checksum:
+                self._lru[bucket.key] = entry  # most recently used
+                self.hits += 1
+                bucket.code = entry[1]
+                return
+        if self.client is not None:
+            try:
+                data = self.client.get(self.prefix + bucket.key)
+            except Exception:
+                LOGGER.warning('memcache error loading bytecode', exc_info=True)
+                data = None
+            if data is not None:
+                # checks magic and checksum, leaves `bucket.code` empty on mismatch
+                bucket.bytecode_from_string(data)
+                if bucket.code is not None:
+                    self._remember(bucket)
+                    with self._lock:
+                        self.memcache_hits += 1
+                    return
+        with self._lock:
+            self.misses += 1
+
+    def dump_bytecode(self, bucket):
+        """Store a freshly compiled template."""
+        self._remember(bucket)
+        if self.client is not None:
+            try:
+                self.client.set(self.prefix + bucket.key, bucket.bytecode_to_string(), self.timeout)
+            except Exception:
+                LOGGER.warning('memcache error storing bytecode', exc_info=True)
+
+    def clear(self):
+        """Empty the in memory tier. Memcache entries expire by themselves."""
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self):
+        """Return hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.memcache_hits + self.misses
+            return dict(
+                hits=self.hits,
+                memcache_hits=self.memcache_hits,
+                misses=self.misses,
+                currsize=len(self._lru),
+                maxsize=self.maxsize,
+                hit_ratio=(float(self.hits + self.memcache_hits) / lookups) if lookups else 0.0,
+            )
+
+    def _remember(self, bucket):
+        with self._lock:
+            self._lru.pop(bucket.key, None)
+            self._lru[bucket.key] = (bucket.checksum, bucket.code)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+
+fragment_cache = TwoTierCache('gaetk2_fragments', maxsize=500, ttl=300)
+
+
+class FragmentCacheExtension(jinja2.ext.Extension):
+    """Cache rendered parts of a template.
+
+    Usage::
+
+        {% cache 'navigation', 600 %}
+            ... expensive stuff ...
+        {% endcache %}
+
+        {% cache 'cart:' ~ cart.id, ttl=60, per_credential=True %}
+            ...
+        {% endcache %}
+
+    The first parameter is the key, the second the number of seconds the
+    fragment is kept (default: 300). With `per_credential=True` the fragment
+    is cached separately for each `credential.uid` in the template context.
+    If there is no credential with a `uid` (e.g. anonymous users) such a
+    fragment is rendered every time and not cached at all. Keys include
+    `gaetk_release`, so a deployment never sees fragments of the previous one.
+
+    Fragments are stored in instance memory and memcache, see
+    :class:`gaetk2.tools.caching.TwoTierCache`. Hit ratios are available via
+    ``fragment_cache.stats()`` and ``/gaetk2/stats/timing``.
+    """
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        ttl = nodes.Const(None)
+        per_credential = nodes.Const(False)
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.test('name') and parser.stream.look().test('assign'):
+                option = next(parser.stream).value
+                next(parser.stream)
+                value = parser.parse_expression()
+                if option == 'ttl':
+                    ttl = value
+                elif option == 'per_credential':
+                    per_credential = value
+                else:
+                    parser.fail('unknown cache option {!r}'.format(option), lineno)
+            else:
+                ttl = parser.parse_expression()
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        args = [key, ttl, per_credential, nodes.Name('credential', 'load')]
+        return nodes.CallBlock(
+            self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, key, ttl, per_credential, credential, caller):
+        uid = ''
+        if per_credential:
+            if credential is None or isinstance(credential, jinja2.Undefined):
+                return caller()
+            uid = getattr(credential, 'uid', None)
+            if not uid:
+                return caller()
+        cache_key = 'fragment:' + hashlib.sha1(repr(
+            [self.environment.globals.get('gaetk_release', ''), key, uid])).hexdigest()
+        value = fragment_cache.get(cache_key)
+        if value is None:
+            value = caller()
+            fragment_cache.set(cache_key, value, ttl=ttl)
+        return value
+
+
+def create_environment(loader, bytecode_cache=None, cache_size=1000):
+    """Return a :class:`jinja2.Environment` configured the gaetk2 way.
+
+    `cache_size` is the number of parsed templates Jinja2 keeps around,
+    the default of 400 is small for applications with many includes.
+
+    Globals are not set here, see
+    :meth:`~gaetk2.handlers.base.BasicHandler._add_jinja2env_globals`.
+    """
+    env = jinja2.Environment(
+        loader=loader,
+        extensions=[FragmentCacheExtension],
+        cache_size=cache_size,
+        auto_reload=False,  # unneeded on App Engine production
+        trim_blocks=True,  # first newline after a block is removed
+        # lstrip_blocks=True,
+        bytecode_cache=bytecode_cache,
+        # This needs jinja2 > Version 2.8
+        autoescape=jinja2.select_autoescape(['html', 'xml']),
+    )
+    jinja_filters.register_custom_filters(env)
+    env.policies['json.dumps_function'] = hujson2.htmlsafe_json_dumps
+    return env
+
+
+# written by :func:`compile_templates` next to the compiled templates
+MANIFEST_NAME = 'manifest.json'
+
+
+def _source_hash(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class CompiledTemplateLoader(jinja2.ModuleLoader):
+    """Load templates compiled by :func:`compile_templates` unless they are stale.
+
+    The manifest written by :func:`compile_templates` contains a hash of
+    the source of each compiled template. A compiled template is only used
+    if the source found by `sourceloader` still has that hash, so a
+    forgotten build step never hides changed templates. This costs reading
+    (but not parsing) the source once per template and instance.
+    """
+
+    def __init__(self, path, sourceloader, manifest):
+        super(CompiledTemplateLoader, self).__init__(path)
+        self.sourceloader = sourceloader
+        self.manifest = manifest
+
+    def load(self, environment, name, globals=None):
+        """Load the compiled template or raise :exc:`jinja2.TemplateNotFound`."""
+        expected = self.manifest.get(name)
+        if expected is None:
+            raise jinja2.TemplateNotFound(name)
+        source = self.sourceloader.get_source(environment, name)[0]
+        if _source_hash(source) != expected:
+            LOGGER.warn('compiled template %s is stale, using the source', name)
+            raise jinja2.TemplateNotFound(name)
+        return super(CompiledTemplateLoader, self).load(environment, name, globals)
+
+
+def read_manifest(compiled_dir):
+    """Return the template hashes written by :func:`compile_templates` or `None`."""
+    try:
+        with open(os.path.join(compiled_dir, MANIFEST_NAME)) as fd:
+            return json.load(fd)['templates']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def get_loader(template_dirs, compiled_dir=None, use_compiled=True):
+    """Return the loader to be used for `template_dirs`.
+
+    If `compiled_dir` contains templates compiled by :func:`compile_templates`
+    they are used and :class:`jinja2.FileSystemLoader` is only consulted for
+    templates not found there or changed since they were compiled.
+    With `use_compiled=False` (in development) templates are always loaded
+    from the file system.
+    """
+    fsloader = jinja2.FileSystemLoader(template_dirs)
+    if use_compiled and compiled_dir and os.path.isdir(compiled_dir):
+        manifest = read_manifest(compiled_dir)
+        if manifest is None:
+            LOGGER.warn('%s has no usable %s, ignoring compiled templates', compiled_dir, MANIFEST_NAME)
+            return fsloader
+        return jinja2.ChoiceLoader([CompiledTemplateLoader(compiled_dir, fsloader, manifest), fsloader])
+    return fsloader
+
+
+def compile_templates(template_dirs, target):
+    """Compile all templates in `template_dirs` into Python modules in `target`.
+
+    Like :class:`jinja2.FileSystemLoader` the first directory containing
+    a template name wins. Templates failing to compile are logged and
+    skipped - at runtime they are then loaded from the file system.
+    A manifest with a hash of each template source is written to `target`,
+    see :class:`CompiledTemplateLoader`.
+
+    Returns:
+        the number of templates found.
+
+    """
+    env = create_environment(jinja2.FileSystemLoader(template_dirs))
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    for name in os.listdir(target):
+        # remove stale templates
+        if name.startswith('tmpl_') and name.endswith('.py'):
+            os.unlink(os.path.join(target, name))
+    templates = env.list_templates()
+    env.compile_templates(
+        target, zip=None, log_function=LOGGER.info, ignore_errors=True, py_compile=False)
+    hashes = {}
+    for name in templates:
+        hashes[name] = _source_hash(env.loader.get_source(env, name)[0])
+    with open(os.path.join(target, MANIFEST_NAME), 'w') as fd:
+        json.dump(dict(templates=hashes), fd, indent=1, sort_keys=True)
+    return len(templates)
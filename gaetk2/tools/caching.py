@@ -9,13 +9,20 @@ Copyright (c) 2007, 2015, 2018 HUDORA GmbH. All rights reserved.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import binascii
+import logging
+import os
 import threading
 import time
 
 from collections import namedtuple
+from collections import OrderedDict
 from functools import update_wrapper
 
 
+logger = logging.getLogger(__name__)
+
+
 # from http://code.activestate.com/recipes/578078-py26-and-py30-backport-of-python-33s-lru-cache/
 # with added TTL
 
@@ -258,3 +265,183 @@ class lru_cache_memcache(object):
             )
         # and warp that in lru_cache.
         return lru_cache(maxsize=self.maxsize, typed=self.typed, ttl=self.ttl)(wraped)
+
+
+class TwoTierCache(object):
+    """Cache values in instance memory and memcache.
+
+    Entries are kept for up to `ttl` seconds. The least recently used
+    entries are dropped from instance memory if there are more than
+    `maxsize`. Memcache is consulted only if the value is not found
+    in instance memory.
+
+    Whole groups of entries can be invalidated on all instances by using a
+    `generation_key`. The generation is a random token kept in memcache,
+    :meth:`invalidate` replaces it and entries stored with another token are
+    ignored. If memcache loses the token a new one is created, so all
+    entries of the group become stale - they never become valid again.
+
+    The generation is read with the same memcache RPC as the entry. So with
+    a `generation_key` even a hit in instance memory costs a memcache RPC.
+    To avoid that set `generation_ttl` to the number of seconds an instance
+    may use a generation without asking memcache again. Invalidations then
+    take up to that long to reach other instances.
+
+    Example::
+
+        cache = TwoTierCache('reports', ttl=300)
+        value, generation = cache.lookup('kunde:123', generation_key='kunden')
+        if value is None:
+            value = expensive_calculation()
+            cache.set('kunde:123', value, generation=generation)
+        ...
+        cache.invalidate('kunden')  # after something changed
+
+    Values must be picklable. Memcache errors are logged and ignored.
+    """
+
+    def __init__(self, namespace, maxsize=500, ttl=300, generation_ttl=0):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation_ttl = generation_ttl
+        self.hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+        self._local = OrderedDict()  # key -> (expires, generation, value)
+        self._generations = {}  # generation_key -> (expires, generation), see `generation_ttl`
+        self._lock = threading.Lock()
+
+    def lookup(self, key, generation_key=None):
+        """Return `(value, generation)`. `value` is `None` if nothing is cached.
+
+        Pass `generation` to :meth:`set` when storing a fresh value.
+        """
+        from google.appengine.api import memcache
+
+        now = time.time()
+        generation = None
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[0] < now:
+                del self._local[key]
+                entry = None
+            if generation_key:
+                cached = self._generations.get(generation_key)
+                if cached is not None and cached[0] >= now:
+                    generation = cached[1]
+        keys = []
+        if generation_key and generation is None:
+            keys.append(generation_key)
+        if entry is None:
+            keys.append(key)
+        found = {}
+        if keys:
+            try:
+                found = memcache.get_multi(keys, namespace=self.namespace)
+            except Exception:
+                logger.warning('memcache error in TwoTierCache %s', self.namespace, exc_info=True)
+        if generation_key and generation is None:
+            generation = found.get(generation_key)
+            if generation is None:
+                generation = self._new_generation(generation_key)
+            else:
+                self._remember_generation(generation_key, generation)
+            if generation is None:
+                # memcache is unavailable, we can't tell if entries are valid
+                with self._lock:
+                    self.misses += 1
+                return None, None
+        if entry is None:
+            entry = found.get(key)
+            if entry is not None and entry[0] >= now and entry[1] == generation:
+                self._remember(key, entry)
+                with self._lock:
+                    self.memcache_hits += 1
+                return entry[2], generation
+        elif entry[1] == generation:
+            with self._lock:
+                self.hits += 1
+                self._local.pop(key, None)
+                self._local[key] = entry  # most recently used
+            return entry[2], generation
+        with self._lock:
+            self.misses += 1
+        return None, generation
+
+    def get(self, key, generation_key=None):
+        """Return the cached value or `None`."""
+        return self.lookup(key, generation_key)[0]
+
+    def set(self, key, value, generation=None, ttl=None):
+        """Store `value` in instance memory and memcache."""
+        from google.appengine.api import memcache
+
+        ttl = ttl or self.ttl
+        entry = (time.time() + ttl, generation, value)
+        self._remember(key, entry)
+        try:
+            memcache.set(key, entry, time=ttl, namespace=self.namespace)
+        except Exception:
+            # e.g. values > 1 MB
+            logger.warning('memcache error in TwoTierCache %s', self.namespace, exc_info=True)
+
+    def invalidate(self, generation_key):
+        """Make all entries stored with `generation_key` invalid on all instances."""
+        from google.appengine.api import memcache
+
+        generation = _random_generation()
+        memcache.set(generation_key, generation, namespace=self.namespace)
+        self._remember_generation(generation_key, generation)
+
+    def _new_generation(self, generation_key):
+        """Start a generation if memcache has none. Returns `None` if memcache fails."""
+        from google.appengine.api import memcache
+
+        generation = _random_generation()
+        try:
+            if not memcache.add(generation_key, generation, namespace=self.namespace):
+                # an other instance was faster
+                generation = memcache.get(generation_key, namespace=self.namespace)
+        except Exception:
+            logger.warning('memcache error in TwoTierCache %s', self.namespace, exc_info=True)
+            return None
+        if generation is not None:
+            self._remember_generation(generation_key, generation)
+        return generation
+
+    def _remember_generation(self, generation_key, generation):
+        if self.generation_ttl:
+            with self._lock:
+                self._generations[generation_key] = (time.time() + self.generation_ttl, generation)
+
+    def clear(self):
+        """Empty the instance memory tier."""
+        with self._lock:
+            self._local.clear()
+            self._generations.clear()
+
+    def stats(self):
+        """Return hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.memcache_hits + self.misses
+            return dict(
+                hits=self.hits,
+                memcache_hits=self.memcache_hits,
+                misses=self.misses,
+                currsize=len(self._local),
+                maxsize=self.maxsize,
+                hit_ratio=(float(self.hits + self.memcache_hits) / lookups) if lookups else 0.0,
+            )
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = entry
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+
+def _random_generation():
+    """Return a new generation token for :class:`TwoTierCache`."""
+    return binascii.hexlify(os.urandom(8))
@@ -77,16 +77,22 @@ def _unknown_handler(value):
 
 
 def dump(val, fd, indent=' ', sort_keys=True):
-    """Dump `val` into `fd` encoded as JSON."""
-    json.dump(val, fd, sort_keys=sort_keys, indent=bool(indent), ensure_ascii=True,
+    """Dump `val` into `fd` encoded as JSON.
+
+    If `indent` is falsy the output is a single line.
+    """
+    json.dump(val, fd, sort_keys=sort_keys, indent=1 if indent else None, ensure_ascii=True,
               default=_unknown_handler)
 
 
 def dumps(val, indent=' ', sort_keys=True):
-    """Return a JSON string containing encoded `val`."""
+    """Return a JSON string containing encoded `val`.
+
+    If `indent` is falsy the output is a single line.
+    """
     start = time.time()
     ret = json.dumps(
-        val, sort_keys=sort_keys, indent=bool(indent), ensure_ascii=True,
+        val, sort_keys=sort_keys, indent=1 if indent else None, ensure_ascii=True,
         default=_unknown_handler)
     delta = time.time() - start
     if delta > 1:
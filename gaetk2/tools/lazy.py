@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gaetk2.tools.lazy - values computed on first use.
+
+Used for template context values which are expensive to compute but often
+not used by the template, see
+:meth:`gaetk2.handlers.base.BasicHandler.build_context`.
+
+Created by Maximillian Dornseif on 2019-03-21.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+
+_unresolved = object()
+
+
+class LazyValue(object):
+    """Proxy calling `func()` on first use and then behaving like the result.
+
+    The result is memoized, so `func` is called at most once.
+
+    Example::
+
+        values['is_staff'] = LazyValue(self.is_staff)
+
+    In templates ``{% if is_staff %}``, ``{{ value }}``, ``{% for x in value %}``,
+    attribute and item access work as usual. Code which needs the real
+    object (e.g. for serialisation) should use :func:`resolve`.
+    """
+
+    __slots__ = ('_func', '_value')
+
+    def __init__(self, func):
+        self._func = func
+        self._value = _unresolved
+
+    def resolve(self):
+        """Return the underlying value, computing it if needed."""
+        if self._value is _unresolved:
+            self._value = self._func()
+            self._func = None
+        return self._value
+
+    @property
+    def is_resolved(self):
+        return self._value is not _unresolved
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __contains__(self, item):
+        return item in self.resolve()
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __nonzero__(self):
+        return bool(self.resolve())
+
+    def __eq__(self, other):
+        return self.resolve() == resolve(other)
+
+    def __ne__(self, other):
+        return self.resolve() != resolve(other)
+
+    def __hash__(self):
+        return hash(self.resolve())
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __str__(self):
+        return str(self.resolve())
+
+    def __unicode__(self):
+        return unicode(self.resolve())
+
+    def __html__(self):
+        value = self.resolve()
+        if hasattr(value, '__html__'):
+            return value.__html__()
+        # let jinja2 do the escaping
+        from jinja2 import escape
+        return escape(value)
+
+    def __repr__(self):
+        if self.is_resolved:
+            return '<LazyValue {!r}>'.format(self._value)
+        return '<LazyValue unresolved>'
+
+
+def resolve(value):
+    """Return `value` or - for a :class:`LazyValue` - the underlying object."""
+    if isinstance(value, LazyValue):
+        return value.resolve()
+    return value
+
+
+def resolve_dict(values):
+    """Return a copy of the dict `values` with all :class:`LazyValue` instances resolved."""
+    return {key: resolve(value) for (key, value) in values.items()}
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gaetk2.tools.metrics - measure where time is spent during a request.
+
+:class:`gaetk2.handlers.base.BasicHandler` times the phases of each
+request (authentication, `method_preperation_hook`, the handler method,
+`build_context`, rendering) with a :class:`PhaseTimer`. The result is sent
+to staff users as a ``Server-Timing`` header (visible in the browser dev
+tools) and aggregated per route in memory. See
+:class:`gaetk2.views.default.TimingStatsHandler` for a JSON view of the
+aggregated percentiles.
+
+Aggregation is per instance. The numbers are meant to spot slow phases,
+not for capacity planning.
+
+Additionally :class:`gaetk2.application.WSGIApplication` counts requests,
+client and server errors and a latency histogram per route via
+:func:`count_request`. These counters are cheap. Every
+:data:`STATS_FLUSH_INTERVAL` seconds they are handed to a deferred task
+which merges them into memcache. :func:`get_request_stats` sums them up
+over all instances, see
+:class:`gaetk2.views.default.RequestStatsHandler`.
+
+Created by Maximillian Dornseif on 2019-03-18.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import bisect
+import collections
+import logging
+import os
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+# how many requests per route we keep for calculating percentiles
+SAMPLES_PER_ROUTE = 500
+
+_local = threading.local()
+_samples = {}  # route -> deque of (total, {phase: seconds})
+_samples_lock = threading.Lock()
+_rpc_hook_installed = False
+
+# upper bounds of the latency histogram buckets in milliseconds. There is
+# an additional bucket for everything slower.
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# seconds between merging local counters into memcache
+STATS_FLUSH_INTERVAL = 60
+# number of memcache entries instances spread their counters over
+STATS_SHARDS = 16
+# fields of the per route counter lists, followed by the histogram buckets
+_FIELDS = ('requests', 'status_4xx', 'status_5xx', 'total_ms')
+_STATS_KEY = 'gaetk2_request_stats:{}'
+
+_counters = {}  # route -> list of ints not yet merged into memcache
+_counters_lock = threading.Lock()
+_last_flush = time.time()
+
+
+class PhaseTimer(object):
+    """Collect durations of named phases and RPC counts for a single request.
+
+    Example::
+
+        timer = PhaseTimer()
+        with timer.phase('authentication'):
+            ...
+        timer.header()  # 'authentication;dur=12.3'
+
+    Phases may nest (``render`` happens inside ``handler``). Phases
+    happening several times are summed up.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.phases = collections.OrderedDict()
+        self.rpcs = collections.Counter()
+
+    @property
+    def total(self):
+        """Seconds since the timer was created."""
+        return time.time() - self.started_at
+
+    def phase(self, name):
+        """Context manager measuring the enclosed code as phase `name`."""
+        return _Phase(self, name)
+
+    def add(self, name, duration):
+        """Add `duration` seconds to phase `name`."""
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def activate(self):
+        """Count RPCs of the current thread in this timer."""
+        _install_rpc_hook()
+        _local.timer = self
+
+    def deactivate(self):
+        """Stop counting RPCs."""
+        if getattr(_local, 'timer', None) is self:
+            _local.timer = None
+
+    def header(self):
+        """Return the value for a ``Server-Timing`` header.
+
+        See https://www.w3.org/TR/server-timing/
+        """
+        parts = ['{};dur={:.1f}'.format(name, duration * 1000) for (name, duration) in self.phases.items()]
+        parts.append('total;dur={:.1f}'.format(self.total * 1000))
+        for service, count in sorted(self.rpcs.items()):
+            parts.append('{};desc="{} RPCs"'.format(service.replace('_', '-'), count))
+        return ', '.join(parts)
+
+
+class _Phase(object):
+    """Context manager used by :meth:`PhaseTimer.phase`."""
+
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timer.add(self.name, time.time() - self.start)
+
+
+def _count_rpc(service, call, request, response):
+    """API proxy hook counting RPCs for the active :class:`PhaseTimer`."""
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.rpcs[service] += 1
+
+
+def _install_rpc_hook():
+    """Register :func:`_count_rpc` with the App Engine API proxy - once."""
+    global _rpc_hook_installed
+    if _rpc_hook_installed:
+        return
+    _rpc_hook_installed = True
+    try:
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('gaetk2_metrics', _count_rpc)
+    except Exception:
+        LOGGER.info('RPC counting not available', exc_info=True)
+
+
+def record(route, timer):
+    """Add the phases measured by `timer` to the statistics for `route`."""
+    phases = dict(timer.phases)
+    total = timer.total
+    with _samples_lock:
+        samples = _samples.get(route)
+        if samples is None:
+            samples = _samples[route] = collections.deque(maxlen=SAMPLES_PER_ROUTE)
+        samples.append((total, phases))
+
+
+def _percentile(values, percent):
+    """Return the `percent` percentile of the sorted list `values`."""
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def get_route_percentiles(percentiles=(50, 90, 99)):
+    """Return latency percentiles per route and phase in milliseconds.
+
+    Returns:
+        A dict like ``{'/foo/<id>': {'count': 17, 'total': {'p50': 12.1, ...},
+        'phases': {'handler': {'p50': 8.2, ...}, ...}}}``.
+
+    """
+    with _samples_lock:
+        snapshot = {route: list(samples) for (route, samples) in _samples.items()}
+    ret = {}
+    for route, samples in snapshot.items():
+        totals = sorted(total for (total, _) in samples)
+        byphase = collections.defaultdict(list)
+        for _, phases in samples:
+            for name, duration in phases.items():
+                byphase[name].append(duration)
+        ret[route] = dict(
+            count=len(samples),
+            total=_percentiles_ms(totals, percentiles),
+            phases={
+                name: _percentiles_ms(sorted(durations), percentiles)
+                for (name, durations) in byphase.items()
+            },
+        )
+    return ret
+
+
+def _percentiles_ms(values, percentiles):
+    return {'p{}'.format(p): round(_percentile(values, p) * 1000, 1) for p in percentiles}
+
+
+def reset():
+    """Forget all collected samples."""
+    with _samples_lock:
+        _samples.clear()
+
+
+def count_request(route, status, duration):
+    """Count a request to `route` which took `duration` seconds."""
+    global _last_flush
+    millis = int(duration * 1000)
+    with _counters_lock:
+        values = _counters.get(route)
+        if values is None:
+            values = _counters[route] = [0] * (len(_FIELDS) + len(LATENCY_BUCKETS) + 1)
+        values[0] += 1
+        if 400 <= status < 500:
+            values[1] += 1
+        elif status >= 500:
+            values[2] += 1
+        values[3] += millis
+        values[len(_FIELDS) + bisect.bisect_left(LATENCY_BUCKETS, millis)] += 1
+        due = time.time() - _last_flush > STATS_FLUSH_INTERVAL
+        if due:
+            _last_flush = time.time()
+    if due:
+        flush_request_stats(defer=True)
+
+
+def _merge(target, source):
+    """Add the counters in `source` to `target`."""
+    for route, values in source.items():
+        if route in target:
+            target[route] = [a + b for (a, b) in zip(target[route], values)]
+        else:
+            target[route] = list(values)
+
+
+def flush_request_stats(defer=False):
+    """Merge the counters of this instance into memcache.
+
+    Each instance always writes to the same shard, so only few instances
+    compete for a memcache entry. With `defer` the counters are sent along
+    with a deferred task doing the compare-and-set loop, so the request
+    being due for flushing only pays for enqueueing a task. On failure the
+    counters are kept for the next try.
+
+    Returns:
+        `True` if the counters could be stored or handed to a task.
+
+    """
+    global _counters
+    with _counters_lock:
+        pending, _counters = _counters, {}
+    if not pending:
+        return True
+    shard = hash(os.environ.get('INSTANCE_ID', '')) % STATS_SHARDS
+    try:
+        if defer:
+            from gaetk2.taskqueue import defer as defer_task
+
+            defer_task(_store_request_stats_task, pending, shard)
+            return True
+        if store_request_stats(pending, shard):
+            return True
+    except Exception:
+        LOGGER.info('could not store request statistics', exc_info=True)
+    with _counters_lock:
+        _merge(_counters, pending)
+    return False
+
+
+def store_request_stats(counters, shard):
+    """Merge `counters` (as collected by :func:`count_request`) into memcache entry `shard`.
+
+    Returns:
+        `False` if there was too much contention for the entry.
+
+    """
+    from google.appengine.api import memcache
+
+    client = memcache.Client()
+    key = _STATS_KEY.format(shard)
+    for _ in range(5):
+        entry = client.gets(key)
+        if entry is None:
+            if client.add(key, dict(since=time.time(), routes=counters)):
+                return True
+            continue
+        _merge(entry['routes'], counters)
+        if client.cas(key, entry):
+            return True
+    return False
+
+
+def _store_request_stats_task(counters, shard):
+    """Deferred by :func:`flush_request_stats`. Fails - and is retried - on contention."""
+    if not store_request_stats(counters, shard):
+        raise RuntimeError('too much contention for request statistics shard {}'.format(shard))
+
+
+def get_request_stats():
+    """Return request counts, error rates and latencies per route of all instances.
+
+    Counters of other instances are up to :data:`STATS_FLUSH_INTERVAL`
+    seconds old. Percentiles are upper bounds of histogram buckets.
+
+    Returns:
+        A dict like ``{'since': 1553000000.0, 'routes': {'GET /foo/<id>':
+        {'requests': 17, 'status_4xx': 1, 'status_5xx': 0, 'error_rate': 0.0,
+        'mean_ms': 12.1, 'p50': 25, 'p90': 50, 'p99': 100,
+        'histogram': {'<=10ms': 3, ...}}}}``.
+
+    """
+    from google.appengine.api import memcache
+
+    flush_request_stats()
+    shards = memcache.get_multi([_STATS_KEY.format(i) for i in range(STATS_SHARDS)])
+    since = min([shard['since'] for shard in shards.values()] or [None])
+    merged = {}
+    for shard in shards.values():
+        _merge(merged, shard['routes'])
+    labels = ['<={}ms'.format(bound) for bound in LATENCY_BUCKETS]
+    labels.append('>{}ms'.format(LATENCY_BUCKETS[-1]))
+    routes = {}
+    for route, values in merged.items():
+        stats = dict(zip(_FIELDS, values))
+        buckets = values[len(_FIELDS):]
+        requests = stats['requests']
+        stats['error_rate'] = round(float(stats['status_5xx']) / requests, 4) if requests else 0.0
+        stats['mean_ms'] = round(float(stats.pop('total_ms')) / requests, 1) if requests else 0.0
+        stats['histogram'] = collections.OrderedDict(zip(labels, buckets))
+        for percent in (50, 90, 99):
+            stats['p{}'.format(percent)] = _bucket_percentile(buckets, requests, percent)
+        routes[route] = stats
+    return dict(since=since, routes=routes)
+
+
+def _bucket_percentile(buckets, count, percent):
+    """Return the upper bound of the histogram bucket containing the `percent` percentile."""
+    if not count:
+        return None
+    seen = 0
+    for pos, bucket in enumerate(buckets):
+        seen += bucket
+        if seen >= count * percent / 100.0:
+            break
+    if pos < len(LATENCY_BUCKETS):
+        return LATENCY_BUCKETS[pos]
+    return None  # slower than all buckets
+
+
+def reset_request_stats():
+    """Forget request statistics of this instance and in memcache."""
+    from google.appengine.api import memcache
+
+    with _counters_lock:
+        _counters.clear()
+    memcache.delete_multi([_STATS_KEY.format(i) for i in range(STATS_SHARDS)])
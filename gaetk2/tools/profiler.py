@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gaetk2.tools.profiler - find out why requests are slow.
+
+A sampling profiler for individual requests. A single helper thread per
+instance looks at the stacks of all profiled request threads every few
+milliseconds via :func:`sys._current_frames`. Sampling starts once a
+request exceeds its latency budget - or right away for one in
+`sample_rate` requests. Fast requests therefore only pay for registering
+and unregistering with the helper thread.
+
+Samples are kept as "folded stacks" (``outer;inner;innermost count``),
+the input format of `FlameGraph <https://github.com/brendangregg/FlameGraph>`_
+and `speedscope <https://www.speedscope.app/>`_. They are aggregated per
+route and the most recent profiles are kept in instance memory.
+
+:class:`gaetk2.handlers.base.BasicHandler` uses this when
+``GAETK2_PROFILER_BUDGET_MS`` or ``GAETK2_PROFILER_SAMPLE_RATE`` are set.
+See :class:`gaetk2.views.default.ProfileHandler` for downloading profiles.
+
+This module does not need the App Engine SDK.
+
+Created by Maximillian Dornseif on 2019-03-26.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import itertools
+import logging
+import os.path
+import random
+import sys
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+# how many profiles we keep
+RECENT_PROFILES = 20
+# frames per sample, deeper stacks are cut at the root
+MAX_DEPTH = 64
+# distinct stacks per route before we start forgetting rare ones
+MAX_STACKS_PER_ROUTE = 5000
+
+_recent = collections.deque(maxlen=RECENT_PROFILES)
+_by_route = {}  # route -> Counter of folded stacks
+_lock = threading.Lock()
+_ids = itertools.count(1)
+
+# profiles currently sampled, guarded by `_active_lock`
+_active = {}  # profile id -> RequestProfile
+_active_lock = threading.Condition(threading.Lock())
+_sampler = None
+
+
+class RequestProfile(object):
+    """Sample the stack of thread `thread_id` until :meth:`stop` is called.
+
+    Sampling starts after `delay` seconds and happens every `interval` seconds.
+    The sampling is done by the shared helper thread, see :func:`_sample_forever`.
+    """
+
+    def __init__(self, route, thread_id, delay=0, interval=0.01):
+        self.id = next(_ids)
+        self.route = route
+        self.thread_id = thread_id
+        self.delay = delay
+        self.interval = interval
+        self.started_at = time.time()
+        self.duration = None
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self._next_sample_at = self.started_at + delay
+        _register(self)
+
+    def stop(self):
+        """Stop sampling and remember the profile if there are samples."""
+        # the helper thread only samples while holding `_active_lock`,
+        # so after this it does not touch `stacks` any more
+        with _active_lock:
+            _active.pop(self.id, None)
+        self.duration = time.time() - self.started_at
+        if self.samples:
+            _store(self)
+            LOGGER.info(
+                'profiled %s: %d ms, %d samples', self.route, self.duration * 1000, self.samples)
+
+    def summary(self):
+        """Return a dict describing the profile without the stacks."""
+        return dict(
+            id=self.id,
+            route=self.route,
+            started_at=self.started_at,
+            duration_ms=round((self.duration or 0) * 1000, 1),
+            samples=self.samples,
+        )
+
+    def folded(self):
+        """Return the samples as folded stacks."""
+        return format_folded(self.stacks)
+
+
+def fold_stack(frame):
+    """Return the stack starting at `frame` as ``outermost;...;innermost``."""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        filename = '/'.join(code.co_filename.split(os.path.sep)[-2:])
+        names.append('{}:{}'.format(filename, code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def format_folded(stacks):
+    """Format a :class:`collections.Counter` of folded stacks, one per line."""
+    return ''.join('{} {}\n'.format(stack, count) for (stack, count) in sorted(stacks.items()))
+
+
+def _register(profile):
+    """Add `profile` to the profiles sampled by the helper thread, start it if needed."""
+    global _sampler
+    with _active_lock:
+        _active[profile.id] = profile
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample_forever, name='gaetk2-profiler')
+            _sampler.daemon = True
+            _sampler.start()
+        _active_lock.notify()
+
+
+def _sample_forever():
+    """Body of the helper thread: sample all due profiles, then sleep until the next is due."""
+    with _active_lock:
+        while True:
+            if not _active:
+                _active_lock.wait()
+                continue
+            now = time.time()
+            due = [profile for profile in _active.values() if profile._next_sample_at <= now]
+            if due:
+                frames = sys._current_frames()
+                for profile in due:
+                    frame = frames.get(profile.thread_id)
+                    if frame is not None:
+                        profile.stacks[fold_stack(frame)] += 1
+                        profile.samples += 1
+                    profile._next_sample_at = now + profile.interval
+                del frames, frame
+            # `_register()` wakes us up early if a profile is added
+            _active_lock.wait(max(0, min(p._next_sample_at for p in _active.values()) - time.time()))
+
+
+def _store(profile):
+    with _lock:
+        _recent.append(profile)
+        stacks = _by_route.get(profile.route)
+        if stacks is None:
+            stacks = _by_route[profile.route] = collections.Counter()
+        stacks.update(profile.stacks)
+        if len(stacks) > MAX_STACKS_PER_ROUTE:
+            _by_route[profile.route] = collections.Counter(
+                dict(stacks.most_common(MAX_STACKS_PER_ROUTE // 2)))
+
+
+def start(route, budget=None, sample_rate=0, interval=0.01):
+    """Start profiling the current thread if needed.
+
+    Parameters:
+        route (str): used to aggregate profiles.
+        budget (float or None): start sampling after this many seconds.
+        sample_rate (int): profile one in `sample_rate` requests completely.
+        interval (float): seconds between samples.
+
+    Returns:
+        A :class:`RequestProfile` to be stopped at the end of the request
+        or `None` if we are not profiling.
+
+    """
+    if sample_rate and random.randrange(sample_rate) == 0:
+        delay = 0
+    elif budget:
+        delay = budget
+    else:
+        return None
+    return RequestProfile(route, threading.current_thread().ident, delay=delay, interval=interval)
+
+
+def get_recent_profiles():
+    """Return summaries of the most recent profiles, newest first."""
+    with _lock:
+        return [profile.summary() for profile in reversed(_recent)]
+
+
+def get_profile(profile_id):
+    """Return the :class:`RequestProfile` with `profile_id` or `None`."""
+    with _lock:
+        for profile in _recent:
+            if profile.id == profile_id:
+                return profile
+    return None
+
+
+def get_folded_stacks(route=None):
+    """Return aggregated folded stacks for `route` or for all routes."""
+    with _lock:
+        if route is not None:
+            return format_folded(_by_route.get(route, {}))
+        stacks = collections.Counter()
+        for counter in _by_route.values():
+            stacks.update(counter)
+    return format_folded(stacks)
+
+
+def reset():
+    """Forget all profiles."""
+    with _lock:
+        _recent.clear()
+        _by_route.clear()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gaetk2.tools.ratelimit - memcache backed token buckets.
+
+Used to throttle access to external resources (ERP, third party APIs)
+across all instances of an application. See
+:func:`gaetk2.taskqueue.defer_ratelimited` for the main usecase.
+
+Created by Maximillian Dornseif on 2019-03-11.
+Copyright (c) 2019 HUDORA. MIT licensed.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+
+logger = logging.getLogger(__name__)
+
+_CAS_RETRIES = 5
+# the state includes the granted/throttled counters, so keep it around
+# much longer than the bucket itself would need
+_STATE_TTL = 24 * 60 * 60
+
+
+class TokenBucket(object):
+    """A token bucket shared between all instances via memcache.
+
+    The bucket holds up to `burst` tokens and is refilled with
+    `rate` tokens per second.
+
+    * :meth:`consume` takes tokens only if they are available.
+    * :meth:`reserve` always takes the tokens - the bucket may go into debt -
+      and tells you how long to wait until your tokens are "really" there.
+      This allows to schedule work exactly at the rate the resource can handle.
+
+    Both return the number of seconds the caller should wait (`0` means go).
+
+    Example::
+
+        SOFTM = TokenBucket('softm', rate=5, burst=10)
+        wait = SOFTM.consume()
+        if wait:
+            # come back later
+            ...
+
+    State is kept in memcache and updated with compare-and-set. The
+    statistics for :func:`get_throttle_stats` are part of that state, so
+    they cost no additional RPC. If memcache is unavailable or contention
+    is extreme we fail open: the token is granted and a warning is logged
+    (and not counted). Rate limiting is a performance optimisation - not
+    a security mechanism.
+    """
+
+    def __init__(self, resource, rate, burst=None):
+        self.resource = resource
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.key = 'gaetk2_ratelimit:{}'.format(resource)
+
+    def __repr__(self):
+        return '<TokenBucket {} rate={} burst={}>'.format(self.resource, self.rate, self.burst)
+
+    def consume(self, tokens=1):
+        """Take `tokens` out of the bucket if they are available.
+
+        Returns:
+            0 if the tokens where granted, else the number of seconds (float)
+            until enough tokens will be available.
+
+        """
+        return self._update(tokens, reserve=False)
+
+    def reserve(self, tokens=1):
+        """Take `tokens` out of the bucket even if this results in a debt.
+
+        Returns:
+            the number of seconds (float) until the caller may use the
+            reserved tokens.
+
+        """
+        return self._update(tokens, reserve=True)
+
+    def _update(self, tokens, reserve):
+        # `memcache.Client` keeps CAS ids per instance, so we need a fresh one
+        client = memcache.Client()
+        for _ in range(_CAS_RETRIES):
+            now = time.time()
+            state = client.gets(self.key)
+            if state is None:
+                level, stamp, granted, throttled = self.burst, now, 0, 0
+            else:
+                level, stamp, granted, throttled = _unpack(state)
+            # refill
+            level = min(self.burst, level + (now - stamp) * self.rate)
+            if level >= tokens:
+                wait = 0
+                level -= tokens
+            else:
+                wait = (tokens - level) / self.rate
+                if reserve:
+                    level -= tokens
+            if wait:
+                throttled += 1
+            else:
+                granted += 1
+            newstate = (level, now, granted, throttled)
+            if state is None:
+                stored = client.add(self.key, newstate, time=_STATE_TTL)
+            else:
+                stored = client.cas(self.key, newstate, time=_STATE_TTL)
+            if stored:
+                return wait
+        logger.warn('token bucket %s: too much contention, granting', self.resource)
+        return 0
+
+    def stats(self):
+        """See :func:`get_throttle_stats`."""
+        return get_throttle_stats(self.resource)
+
+
+def _unpack(state):
+    """Return `(level, stamp, granted, throttled)` from a stored bucket state."""
+    if len(state) == 2:
+        # written by a version without counters
+        return state[0], state[1], 0, 0
+    return state
+
+
+def get_throttle_stats(resource):
+    """Return how often access to `resource` was granted or throttled.
+
+    The `throttle_ratio` is `throttled / (granted + throttled)`. A ratio
+    near 0 means you could push more work to the resource, a high ratio
+    means work is queueing up in front of the resource.
+
+    Counters start from zero when the bucket was unused for a day.
+    """
+    state = memcache.get('gaetk2_ratelimit:{}'.format(resource))
+    granted, throttled = _unpack(state)[2:] if state else (0, 0)
+    total = granted + throttled
+    return dict(
+        resource=resource,
+        granted=granted,
+        throttled=throttled,
+        throttle_ratio=(float(throttled) / total) if total else 0.0)
+
+
+def reset_throttle_stats(resource):
+    """Start counting from zero. This also refills the bucket."""
+    memcache.delete('gaetk2_ratelimit:{}'.format(resource))
@@ -10,9 +10,16 @@ Copyright (c) 2018 Maximillian Dornseif. MIT Licensed.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import base64
+import collections
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
 import warnings
+import zlib
 
 from gaetk2.config import gaetkconfig
 from gaetk2.config import get_environment
@@ -25,6 +32,139 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
 sentry_client = None
 
+_NOTE_CATEGORIES = [
+    'http',
+    'navigation',
+    'user',
+    'rpc',
+    'input',
+    'external',
+    'storage',
+    'auth',
+    'flow',
+]
+
+
+class BreadcrumbBuffer(object):
+    """Per thread ring buffer for breadcrumbs recorded by :func:`note`.
+
+    Breadcrumbs are only transmitted if an event is sent to Sentry - which
+    hopefully happens rarely. So :meth:`record` just keeps a copy of the
+    dicts, lists, tuples and sets in `data` and a cheap size estimate.
+    Conversion to JSON compatible data and truncation happen in
+    :meth:`serialize`.
+
+    The oldest breadcrumbs are dropped if there are more than `maxlen`
+    or their estimated size exceeds `maxsize` bytes.
+    :meth:`gaetk2.application.WSGIApplication.setup_logging` calls
+    :meth:`clear` at the beginning of each request.
+
+    Other objects in `data` (e.g. model instances) are referenced, not
+    copied, and serialized when an event is sent. Don't modify them after
+    handing them to :func:`note`.
+    """
+
+    def __init__(self, maxlen=100, maxsize=100 * 1024):
+        self.maxlen = maxlen
+        self.maxsize = maxsize
+        self._local = threading.local()
+
+    def _get_state(self):
+        if not hasattr(self._local, 'crumbs'):
+            self._local.crumbs = collections.deque()
+            self._local.size = 0
+        return self._local
+
+    def record(self, category, message=None, data=None, typ=None):
+        """Remember a breadcrumb."""
+        state = self._get_state()
+        data = _snapshot(data)
+        size = _estimate_size(message) + _estimate_size(data)
+        state.crumbs.append((time.time(), category, typ, message, data, size))
+        state.size += size
+        # the newest breadcrumb is always kept, it will be truncated in `serialize()`
+        while len(state.crumbs) > self.maxlen or (len(state.crumbs) > 1 and state.size > self.maxsize):
+            state.size -= state.crumbs.popleft()[-1]
+
+    def clear(self):
+        """Forget all breadcrumbs of the current thread."""
+        state = self._get_state()
+        state.crumbs.clear()
+        state.size = 0
+
+    def serialize(self):
+        """Return breadcrumbs in the format expected by Sentry."""
+        ret = []
+        for timestamp, category, typ, message, data, _size in self._get_state().crumbs:
+            crumb = {
+                'timestamp': timestamp,
+                'category': category,
+                'level': 'info',
+                'data': _flatten(data),
+            }
+            if typ:
+                crumb['type'] = typ
+            if message:
+                crumb['message'] = message
+            ret.append(crumb)
+        return ret
+
+    def __len__(self):
+        return len(self._get_state().crumbs)
+
+
+def _snapshot(data, depth=8):
+    """Copy the containers in `data` so later changes by the caller don't show up."""
+    if isinstance(data, dict):
+        if not depth:
+            return unicode(data)
+        return {key: _snapshot(value, depth - 1) for (key, value) in data.items()}
+    if isinstance(data, (list, tuple, set, frozenset)):
+        if not depth:
+            return unicode(data)
+        return [_snapshot(value, depth - 1) for value in data]
+    return data
+
+
+def _estimate_size(data):
+    """Guess the size of `data` in serialized form without serializing it."""
+    if data is None:
+        return 0
+    if isinstance(data, basestring):
+        return len(data)
+    if hasattr(data, 'items'):
+        return sum(
+            len(key) + (len(value) if isinstance(value, basestring) else 32)
+            for (key, value) in data.items()
+            if isinstance(key, basestring)
+        )
+    return 32
+
+
+def _flatten(data):
+    """Convert `data` into JSON compatible data of limited size."""
+    if not data:
+        return {}
+    try:
+        jsondata = hujson2.dumps(data)
+    except Exception as e:
+        return {'error': 'data not serializable', 'exception': str(e)}
+    data = hujson2.loads(jsondata)
+    if len(jsondata) > 10000:
+        # shorten data
+        try:
+            if hasattr(data, 'items'):
+                for key, value in data.items():
+                    data[key] = value[:200]
+            else:
+                data = str(data)[:1024]
+        except Exception as e:
+            data = {'error': 'data too big', 'exception': str(e)}
+    return data
+
+
+breadcrumbs = BreadcrumbBuffer()
+
 
 class _Dummy(object):
     """A class just droping any requests.
@@ -57,20 +197,178 @@ class _Dummy(object):
     def http_context(*args, **kwargs):
         return
 
+    def lazy_context(*args, **kwargs):
+        return
+
+
+def _event_fingerprint(data):
+    """Identify events which are caused by the same problem."""
+    exceptions = (data.get('exception') or {}).get('values')
+    if exceptions:
+        parts = [exceptions[-1].get('type'), exceptions[-1].get('value'), data.get('culprit')]
+    else:
+        parts = [data.get('message'), data.get('culprit')]
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def _decode_event(data):
+    """Decode an event encoded by :meth:`raven.Client.encode`."""
+    try:
+        data = zlib.decompress(data)
+    except zlib.error:
+        pass
+    return json.loads(data)
+
+
+def flush_queue(qname=None, deadline=8 * 60):
+    """Send events queued by :class:`TaskqueueTransport` to Sentry.
+
+    Scheduled automatically a few seconds after events are queued. You might
+    also call it from a cron job to send events which failed the first time.
+
+    Returns:
+        the number of events sent.
 
-if gaetkconfig.SENTRY_DSN and os.environ.get('SERVER_SOFTWARE', '').startswith(
-    'Google App Engine'
+    """
+    from gaetk2.taskqueue import PullQueueConsumer
+    from raven.transport.http import HTTPTransport
+
+    transport = HTTPTransport()
+
+    def send(record):
+        transport.send(record['url'], base64.b64decode(record['data']), record['headers'])
+
+    consumer = PullQueueConsumer(qname or gaetkconfig.SENTRY_QUEUE, send, batch_size=100, workers=8)
+    return consumer.run(deadline=deadline)
+
+
+if gaetkconfig.SENTRY_DSN and (
+    os.environ.get('SERVER_SOFTWARE', '').startswith('Google App Engine')
+    or gaetkconfig.SENTRY_TRANSPORT == 'file'
 ):
     import raven
-    import raven.breadcrumbs
+    from raven.transport.base import Transport
     from raven.transport.http import HTTPTransport
 
+    class TaskqueueTransport(Transport):
+        """Queue events instead of sending them while the request is running.
+
+        Events go to the pull queue ``GAETK2_SENTRY_QUEUE`` and are sent to
+        Sentry in batches by :func:`flush_queue`, which is started as a
+        deferred task at most every 10 seconds. Failing requests are not
+        slowed down further and an unresponsive Sentry server does not affect
+        request handling.
+        """
+
+        def __init__(self, queue=None, **kwargs):
+            # `kwargs` are options from the DSN meant for `HTTPTransport`
+            self.queue = queue or gaetkconfig.SENTRY_QUEUE
+
+        def send(self, url, data, headers):
+            from gaetk2.taskqueue import defer
+            from gaetk2.taskqueue import encode_payload_records
+            from google.appengine.api import taskqueue
+
+            record = dict(url=url, data=base64.b64encode(data), headers=headers)
+            taskqueue.Queue(name=self.queue).add(
+                taskqueue.Task(payload=encode_payload_records([record]), method='PULL'))
+            # one flush for all events queued in a 10 second window
+            now = time.time()
+            defer(
+                flush_queue,
+                self.queue,
+                _name='sentry-flush-{}-{}'.format(self.queue, int(now // 10)),
+                _countdown=int(11 - now % 10),
+            )
+
+    class FileTransport(Transport):
+        """Append events as JSON lines to ``GAETK2_SENTRY_FILE``. Meant for testing."""
+
+        def __init__(self, path=None, **kwargs):
+            self.path = path or gaetkconfig.SENTRY_FILE
+            self._lock = threading.Lock()
+
+        def send(self, url, data, headers):
+            line = json.dumps(_decode_event(data), sort_keys=True)
+            with self._lock:
+                with open(self.path, 'a') as fd:
+                    fd.write(line + '\n')
+
+    _transports = {
+        'http': HTTPTransport,
+        'taskqueue': TaskqueueTransport,
+        'file': FileTransport,
+    }
+
+    class LazyContextClient(raven.Client):
+        """Sentry client which builds context information only when an event is sent.
+
+        Most requests finish without ever sending something to Sentry. So
+        we register functions providing the context and only call them in
+        :meth:`build_msg`.
+        """
+
+        # drop identical events happening more than once per minute
+        deduplicate = False
+
+        def __init__(self, *args, **kwargs):
+            super(LazyContextClient, self).__init__(*args, **kwargs)
+            self._lazy = threading.local()
+
+        def lazy_context(self, kind, func):
+            """Register `func` to provide `user`, `extra` or `http` context.
+
+            `func` is called without parameters. Registering replaces a function
+            registered earlier for the same `kind` in this thread.
+            """
+            assert kind in ('user', 'extra', 'http')
+            if not hasattr(self._lazy, 'funcs'):
+                self._lazy.funcs = {}
+            self._lazy.funcs[kind] = func
+
+        def build_msg(self, *args, **kwargs):
+            """Resolve lazy context and breadcrumbs, then let raven build the event."""
+            funcs = getattr(self._lazy, 'funcs', {})
+            self._lazy.funcs = {}
+            for kind, func in funcs.items():
+                try:
+                    value = func()
+                except Exception:
+                    logger.exception('error building sentry %s context', kind)
+                    continue
+                getattr(self, '{}_context'.format(kind))(value)
+            data = super(LazyContextClient, self).build_msg(*args, **kwargs)
+            crumbs = breadcrumbs.serialize()
+            if crumbs:
+                crumbs.extend(data.get('breadcrumbs', {}).get('values', []))
+                crumbs.sort(key=lambda crumb: crumb.get('timestamp', 0))
+                data['breadcrumbs'] = {'values': crumbs[-breadcrumbs.maxlen:]}
+            return data
+
+        def send(self, auth_header=None, **data):
+            """Send the event unless an identical one was sent during this minute."""
+            if self.deduplicate and not self._first_this_minute(data):
+                logger.info('dropping duplicate sentry event %s', data.get('event_id'))
+                return None
+            return super(LazyContextClient, self).send(auth_header=auth_header, **data)
+
+        def _first_this_minute(self, data):
+            try:
+                from google.appengine.api import memcache
+
+                key = 'gaetk2_sentry_dedup:{}:{}'.format(
+                    _event_fingerprint(data), int(time.time() // 60))
+                return memcache.add(key, 1, time=120)
+            except Exception:
+                logger.info('sentry deduplication failed', exc_info=True)
+                return True
+
     if True:
         # see https://docs.sentry.io/clients/python/advanced/
-        sentry_client = raven.Client(
+        sentry_client = LazyContextClient(
             gaetkconfig.SENTRY_DSN,
             release=get_release(),
-            transport=HTTPTransport,
+            transport=_transports[gaetkconfig.SENTRY_TRANSPORT],
             tags={
                 'MODULE_ID': os.environ.get('CURRENT_MODULE_ID'),
                 'VERSION_ID': os.environ.get('CURRENT_VERSION_ID'),
@@ -102,22 +400,14 @@ if gaetkconfig.SENTRY_DSN and os.environ.get('SERVER_SOFTWARE', '').startswith(
             # # ignore_exceptions = ['Http404', ValueError, ]
         )
         sentry_client.is_active = True
+        sentry_client.deduplicate = gaetkconfig.SENTRY_TRANSPORT == 'taskqueue'
 
     def note(category, message=None, data=None, typ=None):
-        """bei Bedarf strukturiert loggen, Sentry breadcrumbs."""
-        assert category in [
-            'http',
-            'navigation',
-            'user',
-            'rpc',
-            'input',
-            'external',
-            'storage',
-            'auth',
-            'flow',
-        ]
-        if not data:
-            data = {}
+        """bei Bedarf strukturiert loggen, Sentry breadcrumbs.
+
+        `data` is only serialized if an event is sent, see :class:`BreadcrumbBuffer`.
+        """
+        assert category in _NOTE_CATEGORIES
 
         # see https://docs.sentry.io/clients/python/breadcrumbs/
         # and https://github.com/getsentry/sentry/blob/master/src/sentry/static/sentry/less/group-detail.less
@@ -131,40 +421,14 @@ if gaetkconfig.SENTRY_DSN and os.environ.get('SERVER_SOFTWARE', '').startswith(
             category = 'rpc'
             typ = 'http'
 
-        # 'flatten' data
-        jsondata = hujson2.dumps(data)
-        data = hujson2.loads(jsondata)
-        if len(jsondata) > 10000:
-            # shorten data
-            try:
-                if hasattr(data, 'items'):
-                    for key, value in data.items():
-                        data[key] = value[:200]
-                else:
-                    data = str(data)[:1024]
-            except Exception as e:
-                data = {'error': 'data too big', 'exception': str(e)}
-
-        logger.debug('note: %s: %s %r', category, message, data)
-        raven.breadcrumbs.record(
-            data=data, category=category, type=typ, message=message
-        )
+        logger.debug('note: %s: %s', category, message)
+        breadcrumbs.record(category, message=message, data=data, typ=typ)
 
 
 else:
     def note(category, message=None, data=None):
         """Dummy Funktion, die loggt statt zu Sentry zu senden."""
-        assert category in [
-            'http',
-            'navigation',
-            'user',
-            'rpc',
-            'input',
-            'external',
-            'storage',
-            'auth',
-            'flow',
-        ]
+        assert category in _NOTE_CATEGORIES
         logger.debug('note: %s: %s %r', category, message, data)
 
 
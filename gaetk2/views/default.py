@@ -19,6 +19,9 @@ import google.appengine.ext.deferred.deferred
 
 import yaml
 
+from gaetk2 import _gaesessions
+from gaetk2 import exc
+from gaetk2 import templating
 from gaetk2.application import Route
 from gaetk2.application import WSGIApplication
 from gaetk2.config import get_release
@@ -27,6 +30,9 @@ from gaetk2.config import get_version
 from gaetk2.config import is_development
 from gaetk2.config import is_production
 from gaetk2.handlers import DefaultHandler
+from gaetk2.handlers import JsonHandler
+from gaetk2.tools import metrics
+from gaetk2.tools import profiler
 
 from . import backup
 
@@ -149,6 +155,91 @@ class HeatUpHandler(DefaultHandler):
         )
 
 
+class TimingStatsHandler(JsonHandler):
+    """Latency percentiles per route and request phase for this instance.
+
+    See :mod:`gaetk2.tools.metrics`. Also contains cache hit ratios and
+    session sizes. Only available to sysadmins.
+    """
+
+    default_cachingtime = 0
+
+    def authorisation_hook(self, method_name, *args, **kwargs):
+        """Only sysadmins may see the statistics."""
+        if not self.is_sysadmin():
+            raise exc.HTTP403_Forbidden()
+
+    def get(self):
+        """Returns percentiles in milliseconds."""
+        bytecode_cache = self.get_jinja2env().bytecode_cache
+        return dict(
+            instance_id=os.environ.get('INSTANCE_ID'),
+            routes=metrics.get_route_percentiles(),
+            jinja2_bytecode_cache=bytecode_cache.stats() if hasattr(bytecode_cache, 'stats') else None,
+            jinja2_fragment_cache=templating.fragment_cache.stats(),
+            sessions=_gaesessions.get_size_stats(),
+        )
+
+
+class RequestStatsHandler(JsonHandler):
+    """Request counts, error rates and latency histograms per route of all instances.
+
+    See :func:`gaetk2.tools.metrics.get_request_stats`. Only available to sysadmins.
+    """
+
+    default_cachingtime = 0
+
+    def authorisation_hook(self, method_name, *args, **kwargs):
+        """Only sysadmins may see the statistics."""
+        if not self.is_sysadmin():
+            raise exc.HTTP403_Forbidden()
+
+    def get(self):
+        """Returns aggregated counters."""
+        return metrics.get_request_stats()
+
+
+class ProfileHandler(DefaultHandler):
+    """Profiles of slow requests recorded on this instance.
+
+    See :mod:`gaetk2.tools.profiler`. Only available to sysadmins.
+
+    * without parameters: a JSON list of the most recent profiles
+    * ``?id=17``: folded stacks of a single profile
+    * ``?route=GET%20/foo/<id>``: folded stacks aggregated for a route
+    * ``?route=*``: folded stacks aggregated for all routes
+    """
+
+    default_cachingtime = 0
+
+    def authorisation_hook(self, method_name, *args, **kwargs):
+        """Only sysadmins may see profiles."""
+        if not self.is_sysadmin():
+            raise exc.HTTP403_Forbidden()
+
+    def get(self):
+        """Returns profiles."""
+        profile_id = self.request.get('id')
+        route = self.request.get('route')
+        if profile_id:
+            try:
+                profile_id = int(profile_id)
+            except ValueError:
+                raise exc.HTTP400_BadRequest('id must be a number')
+            profile = profiler.get_profile(profile_id)
+            if not profile:
+                raise exc.HTTP404_NotFound()
+            folded = profile.folded()
+        elif route:
+            folded = profiler.get_folded_stacks(None if route == '*' else route)
+        else:
+            self.return_text(
+                json.dumps(profiler.get_recent_profiles()), content_type='application/json')
+            return
+        self.response.headers[b'Content-Disposition'] = b'attachment; filename=profile.folded'
+        self.return_text(folded)
+
+
 application = WSGIApplication(
     [
         Route('/robots.txt', RobotTxtHandler),
@@ -159,6 +250,9 @@ application = WSGIApplication(
         Route('/_ah/warmup', WarmupHandler),
         Route('/gaetk2/heatup/', HeatUpHandler),
         Route('/gaetk2/backup/', backup.BackupHandler),
+        Route('/gaetk2/stats/', RequestStatsHandler),
+        Route('/gaetk2/stats/timing', TimingStatsHandler),
+        Route('/gaetk2/stats/profiles', ProfileHandler),
         (r'^/_ah/queue/deferred.*', google.appengine.ext.deferred.deferred.TaskHandler),
     ]
 )